@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of generators, mockup creation and tastypie payloads.
+
+Benchmarks are described with a spec, see the chocolate_benchmark command:
+
+    {
+        "repeat": 200,
+        "generators": true,
+        "mockups": {
+            "blog.Entry": {},
+            "blog.Movie": {"actors": 3}
+        },
+        "api": "blog.api.api",
+        "resources": {
+            "entry": ["get", "post"]
+        },
+        "budgets": {
+            "blog.Entry": 2
+        }
+    }
+
+Every benchmark reports its rate, the p50 and p95 latencies of a single
+operation in milliseconds and peak_memory_growth_kb, how many kilobytes the
+benchmark raised the peak resident memory of the process. The peak never
+goes down, so a benchmark using less memory than an earlier one reports 0.
+The queries each Mockup.create takes are reported in expected_queries, and
+checked against the budgets of the spec by check_budgets.
+
+"""
+
+import math
+import os
+import platform
+import sys
+import time
+
+import django
+from django.db import connections, DEFAULT_DB_ALIAS
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    getrusage = None
+
+import generators
+from instrumentation import enable_query_log, restore_query_log
+from models import FIELDCLASS_TO_GENERATOR, ModelFactory, make_generator
+from specs import get_model_class, import_object
+
+# arguments required to build an instance of some field classes
+FIELD_ARGUMENTS = {
+    'CharField': {'max_length': 100},
+    'DecimalField': {'max_digits': 10, 'decimal_places': 2},
+    'FilePathField': {'path': os.path.dirname(__file__)},
+}
+
+
+def get_peak_memory():
+    """Returns the peak resident memory of the process in kilobytes."""
+
+    if getrusage is None:
+        return None
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes
+        peak //= 1024
+    return peak
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * p / 100.0))
+    return values[index]
+
+
+def measure(operation, repeat):
+    """Calls operation repeat times. Returns the statistics of the calls."""
+
+    peak_memory = get_peak_memory()
+    latencies = []
+    for i in xrange(repeat):
+        start = time.time()
+        operation()
+        latencies.append(time.time() - start)
+
+    memory_growth = None
+    if peak_memory is not None:
+        memory_growth = get_peak_memory() - peak_memory
+
+    total = sum(latencies)
+    return {
+        'count': repeat,
+        'seconds': total,
+        'per_second': repeat / total if total else None,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'peak_memory_growth_kb': memory_growth,
+    }
+
+
+def benchmark_generators(repeat):
+    """Measures the generator of every field class in
+    FIELDCLASS_TO_GENERATOR, one value at a time and in batches."""
+
+    results = {}
+    for field_class in FIELDCLASS_TO_GENERATOR:
+        name = field_class.__name__
+        generator = make_generator(
+            field_class(**FIELD_ARGUMENTS.get(name, {})))
+
+        result = measure(generator.get_value, repeat)
+        start = time.time()
+        generator.get_values(repeat)
+        seconds = time.time() - start
+        result['batch_per_second'] = repeat / seconds if seconds else None
+        results[name] = result
+    return results
+
+
+def count_queries(operation, using=DEFAULT_DB_ALIAS):
+    """Returns a function calling operation that counts the queries it
+    runs in its queries attribute."""
+
+    connection = connections[using]
+
+    def counted():
+        start = len(connection.queries)
+        operation()
+        counted.queries += len(connection.queries) - start
+
+    counted.queries = 0
+    return counted
+
+
+def benchmark_mockups(factory, mockups, repeat):
+    """Measures Mockup.create for every model label in mockups, a dict of
+    the forced values used for each model."""
+
+    results = {}
+    for label, force in mockups.items():
+        mockup = factory[get_model_class(label)]
+        operation = count_queries(lambda: mockup.create(**force))
+
+        states = enable_query_log()
+        try:
+            result = measure(operation, repeat)
+        finally:
+            restore_query_log(states)
+
+        result['queries_per_object'] = operation.queries / float(repeat)
+        results[label] = result
+    return results
+
+
+def get_expected_queries(results):
+    """Returns the queries per Mockup.create of every model in the results
+    of benchmark_mockups, rounded up."""
+
+    return dict((label, int(math.ceil(result['queries_per_object'])))
+                for label, result in results.items())
+
+
+def check_budgets(budgets, results):
+    """Returns a message for every model whose queries per create in the
+    results of run_benchmarks exceed its budget."""
+
+    expected = results.get('expected_queries', {})
+    return ['%s takes %d queries per create, the budget is %d' % (
+                label, expected[label], budget)
+            for label, budget in sorted(budgets.items())
+            if label in expected and expected[label] > budget]
+
+
+def benchmark_resources(tasty_factory, resources, repeat):
+    """Measures create_get_data and create_post_data for the resource
+    names in resources, a dict of lists with "get" and "post"."""
+
+    results = {}
+    for name, methods in resources.items():
+        mockup = tasty_factory[name]
+        for method in methods:
+            operation = getattr(mockup, 'create_%s_data' % method)
+            results['%s.%s' % (name, method)] = measure(operation, repeat)
+    return results
+
+
+def run_benchmarks(spec, factory=None):
+    """Runs the benchmarks of spec against the default database. Returns
+    their results as a dict."""
+
+    repeat = spec.get('repeat', 100)
+    factory = factory or ModelFactory()
+    generators.seed(spec.get('seed', 0))
+
+    results = {}
+    if spec.get('generators', True):
+        results['generators'] = benchmark_generators(repeat)
+
+    if spec.get('mockups'):
+        results['mockups'] = benchmark_mockups(factory, spec['mockups'],
+                                               repeat)
+        results['expected_queries'] = get_expected_queries(
+            results['mockups'])
+
+    if spec.get('resources'):
+        from rest import TastyFactory
+
+        tasty_factory = TastyFactory(import_object(spec['api']), factory)
+        results['resources'] = benchmark_resources(
+            tasty_factory, spec['resources'], repeat)
+
+    return results
+
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'numpy': generators.numpy is not None,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
@@ -4,9 +4,12 @@
 # Copyright (c) 2010, Mikko Hellsing
 # All rights reserved.
 
+import array
+import binascii
 import datetime
+import json
 import os
-import random
+import random as random_module
 import re
 import string
 import uuid
@@ -14,6 +17,12 @@ from decimal import Decimal
 from django.utils.timezone import now, is_naive, utc
 from django.conf import settings
 
+# numpy is optional, it is only used to generate many values at once faster
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # backporting os.path.relpath, only availabe in python >= 2.6
 try:
     relpath = os.path.relpath
@@ -37,6 +46,134 @@ except AttributeError:
         return os.path.join(*rel_list)
 
 
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# stream of random values used by every generator, replaced by seed()
+random = random_module.Random()
+
+
+def seed(value=None):
+    """Starts a new stream of random values for the generators, seeded with
+    value. Buffered random characters and lorem pools are discarded and
+    numpy, when available, is seeded from the new stream too."""
+
+    global random
+    random = random_module.Random(value)
+    character_buffers.clear()
+    lorem_pools.clear()
+    if numpy is not None:
+        numpy.random.seed(None if value is None else random.getrandbits(32))
+
+
+def random_integers(low, high, n):
+    """Returns a list of n random integers between low and high, both
+    included."""
+
+    if numpy is not None and INT64_MIN <= low and high < INT64_MAX:
+        return numpy.random.randint(low, high + 1, size=n).tolist()
+
+    span = high - low + 1
+    if span <= 2 ** 53:
+        rand = random.random
+        return [low + int(rand() * span) for x in xrange(n)]
+
+    randint = random.randint
+    return [randint(low, high) for x in xrange(n)]
+
+
+def random_mask(n, p):
+    """Returns a list of n booleans, each one being True with probability
+    p."""
+
+    if numpy is not None:
+        return (numpy.random.random_sample(n) < p).tolist()
+
+    rand = random.random
+    return [rand() < p for x in xrange(n)]
+
+
+def random_bytes(n):
+    """Returns a string of n random bytes taken from the random module, so
+    seeding it makes them reproducible."""
+
+    if not n:
+        return ''
+    return binascii.unhexlify('%0*x' % (2 * n, random.getrandbits(8 * n)))
+
+
+class RandomCharacters(object):
+    """Buffer of random characters from chars.
+
+    The buffer is filled in blocks by translating random bytes through a
+    lookup table, strings are then sliced from it without calling the random
+    module once per character.
+
+    """
+
+    block_size = 2 ** 14
+
+    def __init__(self, chars):
+        self.chars = chars
+        self.buffer = u''
+        self.position = 0
+
+        if len(chars) <= 256 and all(ord(char) < 128 for char in chars):
+            # bytes above limit are dropped so every char is equally likely
+            limit = 256 - 256 % len(chars)
+            table = [str(chars[i % len(chars)]) for i in xrange(limit)]
+            table += ['\0'] * (256 - limit)
+            self.table = ''.join(table)
+            self.deleted = ''.join(chr(i) for i in xrange(limit, 256))
+        else:
+            self.table = None
+
+    def fill(self, length):
+        """Refills the buffer with at least length characters."""
+
+        size = max(self.block_size, length)
+        chunks = [self.buffer[self.position:]]
+        missing = size - len(chunks[0])
+
+        while missing > 0:
+            if self.table is None:
+                choice = random.choice
+                chunk = u''.join([choice(self.chars)
+                                  for x in xrange(missing)])
+            else:
+                chunk = random_bytes(missing + missing / 4 + 8)
+                chunk = chunk.translate(self.table, self.deleted)
+                chunk = chunk[:missing].decode('ascii')
+            chunks.append(chunk)
+            missing -= len(chunk)
+
+        self.buffer = u''.join(chunks)
+        self.position = 0
+
+    def take(self, length):
+        """Returns a string of length random characters."""
+
+        if self.position + length > len(self.buffer):
+            self.fill(length)
+        value = self.buffer[self.position:self.position + length]
+        self.position += length
+        return value
+
+
+# RandomCharacters buffers, by set of characters
+character_buffers = {}
+
+
+def get_character_buffer(chars):
+    """Returns the shared RandomCharacters buffer for chars."""
+
+    try:
+        return character_buffers[chars]
+    except KeyError:
+        buffer = character_buffers[chars] = RandomCharacters(chars)
+        return buffer
+
+
 class GeneratorException(Exception):
     pass
 
@@ -70,6 +207,26 @@ class Generator(object):
         value = self.generate()
         return self.coerce(value)
 
+    def generate_values(self, n):
+        """Generates n values. Subclasses override this to generate all of
+        them in a single pass."""
+
+        return [self.generate() for x in xrange(n)]
+
+    def get_values(self, n):
+        """Returns a list of n values, as n calls to get_value would."""
+
+        coerce = self.coerce
+
+        if not self.empty_p:
+            return [coerce(value) for value in self.generate_values(n)]
+
+        mask = random_mask(n, self.empty_p)
+        values = iter(self.generate_values(n - sum(mask)))
+        empty_value = self.empty_value
+        return [empty_value if empty else coerce(values.next())
+                for empty in mask]
+
     def dehydrated_value(self):
         return unicode(self.get_value())
 
@@ -105,6 +262,16 @@ class UUIDGenerator(Generator):
             value = value[:self.max_length]
         return value
 
+    def generate_values(self, n):
+        # uuid1 takes a lock and reads the clock for every value, random
+        # version 4 uuids are built from a single read of random bytes.
+        data = random_bytes(16 * n)
+        values = [unicode(uuid.UUID(bytes=data[i:i + 16], version=4))
+                  for i in xrange(0, 16 * n, 16)]
+        if self.max_length is not None:
+            values = [value[:self.max_length] for value in values]
+        return values
+
 
 class StringGenerator(Generator):
     coerce_type = unicode
@@ -128,10 +295,18 @@ class StringGenerator(Generator):
 
     def generate(self):
         length = random.randint(self.min_length, self.max_length)
-        value = u''
-        for x in xrange(length):
-            value += random.choice(self.chars)
-        return value
+        return get_character_buffer(self.chars).take(length)
+
+    def generate_values(self, n):
+        lengths = random_integers(self.min_length, self.max_length, n)
+        text = get_character_buffer(self.chars).take(sum(lengths))
+
+        values = []
+        position = 0
+        for length in lengths:
+            values.append(text[position:position + length])
+            position += length
+        return values
 
 
 class SlugGenerator(StringGenerator):
@@ -142,6 +317,134 @@ class SlugGenerator(StringGenerator):
                 chars, multiline=False, *args, **kwargs)
 
 
+class LoremPool(object):
+    """Lorem ipsum units (words, sentences or paragraphs) generated once.
+
+    Values join units picked independently from the pool, so count units
+    give len(units) ** count different values. Pools can be saved to and
+    loaded from json files.
+
+    """
+
+    sizes = {'w': 5000, 's': 5000}
+    default_size = 500
+
+    def __init__(self, method, common, units=None):
+        from django.contrib.webdesign import lorem_ipsum
+
+        self.method = method
+        self.common = common
+
+        if method in ('w', 's'):
+            self.separator = u' '
+        else:
+            self.separator = u'\n\n'
+
+        self.common_units = []
+        if common:
+            if method == 'w':
+                self.common_units = list(lorem_ipsum.COMMON_WORDS)
+            elif method == 'p':
+                self.common_units = [u'<p>%s</p>' % lorem_ipsum.COMMON_P]
+            elif method != 's':
+                self.common_units = [lorem_ipsum.COMMON_P]
+
+        if units is None:
+            units = self.generate_units(
+                self.sizes.get(method, self.default_size))
+        self.units = [unicode(unit) for unit in units]
+
+    def generate_units(self, n):
+        from django.contrib.webdesign import lorem_ipsum
+
+        words = lorem_ipsum.WORDS
+        if self.method == 'w':
+            return [random.choice(words) for i in xrange(n)]
+        if self.method == 's':
+            return [self.make_sentence(words) for i in xrange(n)]
+        paras = [self.make_paragraph(words) for i in xrange(n)]
+        if self.method == 'p':
+            paras = [u'<p>%s</p>' % p for p in paras]
+        return paras
+
+    def make_sentence(self, words):
+        """Returns a sentence like lorem_ipsum.sentence, which would use the
+        random module instead of the stream of the generators."""
+
+        sections = [u' '.join(random.sample(words, random.randint(3, 12)))
+                    for i in xrange(random.randint(1, 5))]
+        text = u', '.join(sections)
+        return u'%s%s%s' % (text[0].upper(), text[1:], random.choice('?.'))
+
+    def make_paragraph(self, words):
+        return u' '.join(self.make_sentence(words)
+                         for i in xrange(random.randint(1, 4)))
+
+    def get_text(self, count, length=None):
+        """Returns count units of lorem text, cut at length characters."""
+
+        parts = self.common_units[:count]
+        count -= len(parts)
+
+        if count:
+            units = self.units
+            size = sum(len(part) + len(self.separator) for part in parts)
+            for index in random_integers(0, len(units) - 1, count):
+                # units past length would be cut anyway
+                if length is not None and size >= length:
+                    break
+                parts.append(units[index])
+                size += len(units[index]) + len(self.separator)
+
+        text = self.separator.join(parts)
+        if length is not None:
+            text = text[:length]
+        return text
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.units, f)
+
+    @classmethod
+    def load(cls, path, method, common):
+        with open(path) as f:
+            return cls(method, common, units=json.load(f))
+
+
+# LoremPool instances, by (method, common)
+lorem_pools = {}
+
+
+def get_lorem_pool(method, common):
+    """Returns the LoremPool for the given method and common flag.
+
+    If settings.CHOCOLATE_LOREM_DIR is set, pools are stored in that
+    directory and reused by later runs.
+
+    """
+
+    key = (method, bool(common))
+
+    try:
+        return lorem_pools[key]
+    except KeyError:
+        pass
+
+    directory = getattr(settings, 'CHOCOLATE_LOREM_DIR', None)
+    if directory:
+        path = os.path.join(directory, 'lorem-%s-%d.json' % key)
+        if os.path.exists(path):
+            pool = LoremPool.load(path, *key)
+        else:
+            pool = LoremPool(*key)
+            pool.save(path)
+    else:
+        pool = LoremPool(*key)
+
+    lorem_pools[key] = pool
+    return pool
+
+
 class LoremGenerator(Generator):
     coerce_type = unicode
     common = True
@@ -160,21 +463,12 @@ class LoremGenerator(Generator):
         super(LoremGenerator, self).__init__(*args, **kwargs)
 
     def generate(self):
-        from django.contrib.webdesign.lorem_ipsum import paragraphs, sentence,\
-            words
-        if self.method == 'w':
-            lorem = words(self.count, common=self.common)
-        elif self.method == 's':
-            lorem = u' '.join([sentence()
-                for i in xrange(self.count)])
-        else:
-            paras = paragraphs(self.count, common=self.common)
-            if self.method == 'p':
-                paras = ['<p>%s</p>' % p for p in paras]
-            lorem = u'\n\n'.join(paras)
+        pool = get_lorem_pool(self.method, self.common)
         if self.max_length:
             length = random.randint(self.max_length / 10, self.max_length)
-            lorem = lorem[:max(1, length)]
+            lorem = pool.get_text(self.count, max(1, length))
+        else:
+            lorem = pool.get_text(self.count)
         return lorem.strip()
 
 
@@ -207,6 +501,9 @@ class IntegerGenerator(Generator):
         value = random.randint(self.min_value, self.max_value)
         return value
 
+    def generate_values(self, n):
+        return random_integers(self.min_value, self.max_value, n)
+
     def dehydrated_vaue(self):
         return self.generate_value()
 
@@ -243,6 +540,16 @@ class FloatGenerator(Generator):
             10 ** self.decimal_places)
         return value
 
+    def generate_values(self, n):
+        maxint = 10 ** self.max_digits - 1
+        scale = float(10 ** self.decimal_places)
+        if numpy is not None:
+            values = numpy.floor(
+                numpy.random.uniform(-maxint, maxint + 1, n)) / scale
+            return values.tolist()
+        return [float(value) / scale
+                for value in random_integers(-maxint, maxint, n)]
+
     def dehydrated_value(self):
         return self.generate_value()
 
@@ -258,6 +565,11 @@ class ChoiceGenerator(Generator):
     def generate(self):
         return random.choice(self.choices)
 
+    def generate_values(self, n):
+        choices = self.choices
+        return [choices[i]
+                for i in random_integers(0, len(choices) - 1, n)]
+
 
 class BooleanGenerator(ChoiceGenerator):
     choices = (True, False)
@@ -293,6 +605,15 @@ class DateTimeGenerator(Generator):
             output = output.replace(tzinfo=None)
         return output
 
+    def generate_values(self, n):
+        diff = self.max_date - self.min_date
+        min_date = self.min_date
+        if not settings.USE_TZ:
+            min_date = min_date.replace(tzinfo=None)
+        timedelta = datetime.timedelta
+        return [min_date + timedelta(seconds=seconds) for seconds in
+                random_integers(0, diff.days * 3600 * 24 + diff.seconds, n)]
+
 
 class DateGenerator(Generator):
     min_date = datetime.date.today() - datetime.timedelta(365 * 5)
@@ -312,6 +633,13 @@ class DateGenerator(Generator):
         date = self.min_date + datetime.timedelta(days=days)
         return date
 
+    def generate_values(self, n):
+        diff = self.max_date - self.min_date
+        first_day = self.min_date.toordinal()
+        fromordinal = datetime.date.fromordinal
+        return [fromordinal(first_day + days)
+                for days in random_integers(0, diff.days, n)]
+
 
 class DecimalGenerator(Generator):
     coerce_type = Decimal
@@ -333,45 +661,137 @@ class DecimalGenerator(Generator):
             10 ** self.decimal_places)
         return value
 
+    def generate_values(self, n):
+        maxint = 10 ** self.max_digits - 1
+        places = -self.decimal_places
+        return [Decimal(value).scaleb(places)
+                for value in random_integers(-maxint, maxint, n)]
+
+
+class PatternGenerator(Generator):
+    """Generates strings following a pattern such as
+    ``"{word:1-8}@{word:1-10}.{tld}"``.
 
-class EmailGenerator(StringGenerator):
+    The pattern is parsed once. Placeholders can be ``{word:min-max}``, a
+    string of chars with a length between min and max, ``{int:min-max}``, an
+    integer between min and max, or the name of one of the given pools, a
+    value chosen from that sequence.
+
+    """
+
+    coerce_type = unicode
     chars = string.ascii_lowercase
+    placeholder_re = re.compile(r'\{(\w+)(?::(\d+)-(\d+))?\}')
 
-    def __init__(self, chars=None, max_length=30, tlds=None, *args, **kwargs):
-        assert max_length >= 6
+    def __init__(self, pattern, chars=None, pools=None, *args, **kwargs):
         if chars is not None:
             self.chars = chars
-        self.tlds = tlds
-        super(EmailGenerator, self).__init__(self.chars, max_length=max_length,
-                *args, **kwargs)
+        self.pattern = pattern
+        self.pools = pools or {}
+        self.parts = self.parse(pattern)
+        super(PatternGenerator, self).__init__(*args, **kwargs)
+
+    def parse(self, pattern):
+        """Returns the pattern as a list of (kind, arguments) tuples."""
+
+        parts = []
+        position = 0
+        for match in self.placeholder_re.finditer(pattern):
+            if match.start() > position:
+                parts.append(('literal', pattern[position:match.start()]))
+            position = match.end()
+
+            name, low, high = match.groups()
+            if name in ('word', 'int') and low is None:
+                msg = "Placeholder %s requires a range" % match.group()
+                raise GeneratorException(msg)
+            elif name == 'word':
+                parts.append((name, StringGenerator(
+                    self.chars, min_length=int(low), max_length=int(high))))
+            elif name == 'int':
+                parts.append((name, (int(low), int(high))))
+            elif name in self.pools:
+                parts.append(('choice', tuple(self.pools[name])))
+            else:
+                msg = "Unknown placeholder %s" % match.group()
+                raise GeneratorException(msg)
+
+        if position < len(pattern):
+            parts.append(('literal', pattern[position:]))
+        return parts
 
     def generate(self):
-        maxl = self.max_length - 2
-        if self.tlds:
-            tld = random.choice(self.tlds)
-        elif maxl > 4:
-            tld = StringGenerator(
-                    self.chars, min_length=3, max_length=3).generate()
-        maxl -= len(tld)
+        return self.generate_values(1)[0]
+
+    def generate_values(self, n):
+        columns = []
+        for kind, arguments in self.parts:
+            if kind == 'literal':
+                columns.append([arguments] * n)
+            elif kind == 'int':
+                columns.append([unicode(value)
+                                for value in random_integers(*arguments + (n,))])
+            elif kind == 'choice':
+                columns.append([arguments[i] for i in
+                                random_integers(0, len(arguments) - 1, n)])
+            else:
+                columns.append(arguments.generate_values(n))
+        return [u''.join(parts) for parts in zip(*columns)]
+
+
+def get_word_ranges(min_length, fixed_length, ranges):
+    """Raises the lower bounds of the given (min, max) word lengths so that
+    with fixed_length more characters the text has at least min_length
+    characters, if the maximums allow it."""
+
+    missing = min_length - fixed_length - sum(low for low, high in ranges)
+    raised = []
+    for low, high in ranges:
+        extra = max(0, min(high - low, missing))
+        missing -= extra
+        raised.append((low + extra, high))
+    return raised
+
+
+class EmailGenerator(PatternGenerator):
+
+    def __init__(self, chars=None, max_length=30, tlds=None, multiline=False,
+                 min_length=1, *args, **kwargs):
+        # multiline is accepted for compatibility, emails are single lines
+        assert max_length >= 6
+        assert min_length <= max_length
+        self.min_length = min_length
+        self.max_length = max_length
+        self.tlds = tlds
+
+        pools = {}
+        maxl = max_length - 2
+        if tlds:
+            pools['tld'] = tlds
+            tld = '{tld}'
+            maxl -= max(len(tld) for tld in tlds)
+            tld_length = min(len(tld) for tld in tlds)
+        else:
+            tld_length = 3 if maxl > 4 else 2
+            tld = '{word:%d-%d}' % (tld_length, tld_length)
+            maxl -= tld_length
         assert maxl >= 2
 
-        name = StringGenerator(
-                self.chars, min_length=1, max_length=maxl - 1).generate()
-        maxl -= len(name)
-        domain = StringGenerator(
-                self.chars, min_length=1, max_length=maxl).generate()
-        return '%s@%s.%s' % (name, domain, tld)
+        name, domain = get_word_ranges(min_length, 2 + tld_length,
+                                       [(1, maxl - maxl / 2), (1, maxl / 2)])
+        pattern = '{word:%d-%d}@{word:%d-%d}.%s' % (name + domain + (tld,))
+        super(EmailGenerator, self).__init__(pattern, chars, pools,
+                                             *args, **kwargs)
 
 
-class URLGenerator(StringGenerator):
-    chars = string.ascii_lowercase
+class URLGenerator(PatternGenerator):
     protocol = 'http'
     tlds = ()
 
     def __init__(self, chars=None, max_length=30, protocol=None, tlds=None,
-        *args, **kwargs):
-        if chars is not None:
-            self.chars = chars
+        multiline=False, min_length=1, *args, **kwargs):
+        # multiline is accepted for compatibility, URLs are single lines
+        assert min_length <= max_length
         if protocol is not None:
             self.protocol = protocol
         if tlds is not None:
@@ -380,33 +800,37 @@ class URLGenerator(StringGenerator):
             len(self.protocol) + len('://') +
             1 + len('.') +
             max([2] + [len(tld) for tld in self.tlds if tld]))
-        super(URLGenerator, self).__init__(
-            chars=self.chars, max_length=max_length, *args, **kwargs)
+        self.min_length = min_length
+        self.max_length = max_length
 
-    def generate(self):
-        maxl = self.max_length - len(self.protocol) - 4  # len(://) + len(.)
+        pools = {}
+        fixed_length = len(self.protocol) + 4  # len(://) + len(.)
+        maxl = max_length - fixed_length
         if self.tlds:
-            tld = random.choice(self.tlds)
-            maxl -= len(tld)
+            pools['tld'] = self.tlds
+            tld = '{tld}'
+            maxl -= max(len(tld) for tld in self.tlds)
+            [host] = get_word_ranges(
+                min_length,
+                fixed_length + min(len(tld) for tld in self.tlds),
+                [(1, maxl)])
         else:
             tld_max_length = 3 if maxl >= 5 else 2
-            tld = StringGenerator(self.chars,
-                min_length=2, max_length=tld_max_length).generate()
-            maxl -= len(tld)
-        domain = StringGenerator(chars=self.chars, max_length=maxl).generate()
-        return u'%s://%s.%s' % (self.protocol, domain, tld)
+            maxl -= tld_max_length
+            host, tld = get_word_ranges(min_length, fixed_length,
+                                        [(1, maxl), (2, tld_max_length)])
+            tld = '{word:%d-%d}' % tld
 
+        pattern = '%s://{word:%d-%d}.%s' % ((self.protocol,) + host + (tld,))
+        super(URLGenerator, self).__init__(pattern, chars, pools,
+                                           *args, **kwargs)
 
-class IPAddressGenerator(Generator):
-    coerce_type = unicode
 
-    def generate(self):
-        return '.'.join([unicode(part) for part in [
-            IntegerGenerator(min_value=1, max_value=254).generate(),
-            IntegerGenerator(min_value=0, max_value=254).generate(),
-            IntegerGenerator(min_value=0, max_value=254).generate(),
-            IntegerGenerator(min_value=1, max_value=254).generate(),
-        ]])
+class IPAddressGenerator(PatternGenerator):
+
+    def __init__(self, **kwargs):
+        super(IPAddressGenerator, self).__init__(
+            '{int:1-254}.{int:0-254}.{int:0-254}.{int:1-254}', **kwargs)
 
 
 class TimeGenerator(Generator):
@@ -418,8 +842,26 @@ class TimeGenerator(Generator):
             random.randint(0, 999999),
         )
 
+    def generate_values(self, n):
+        values = []
+        time = datetime.time
+        for value in random_integers(0, 24 * 3600 * 10 ** 6 - 1, n):
+            seconds, microseconds = divmod(value, 10 ** 6)
+            minutes, seconds = divmod(seconds, 60)
+            hours, minutes = divmod(minutes, 60)
+            values.append(time(hours, minutes, seconds, microseconds))
+        return values
+
 
 class FilePathGenerator(Generator):
+    """Chooses the path of an existing file.
+
+    The list of candidate files is kept until the modification time of path
+    changes. Changes in subdirectories of a recursive generator don't update
+    that time, call refresh() to scan the files again.
+
+    """
+
     coerce_type = unicode
 
     def __init__(self, path, match=None, recursive=False, max_length=None,
@@ -428,16 +870,25 @@ class FilePathGenerator(Generator):
         self.match = match
         self.recursive = recursive
         self.max_length = max_length
+        self.refresh()
         super(FilePathGenerator, self).__init__(*args, **kwargs)
 
-    def generate(self):
+    def refresh(self):
+        """Discards the cached list of files."""
+
+        self.filenames = None
+        self.mtime = None
+
+    def scan(self):
+        """Returns the list of files to choose from."""
+
         filenames = []
         if self.match:
             match_re = re.compile(self.match)
         if self.recursive:
             for root, dirs, files in os.walk(self.path):
                 for f in files:
-                    if self.match is None or self.match.search(f):
+                    if self.match is None or match_re.search(f):
                         f = os.path.join(root, f)
                         filenames.append(f)
         else:
@@ -451,7 +902,31 @@ class FilePathGenerator(Generator):
                 pass
         if self.max_length:
             filenames = [fn for fn in filenames if len(fn) <= self.max_length]
-        return random.choice(filenames)
+        return filenames
+
+    def get_filenames(self):
+        """Returns the cached list of files, scanning them again if path was
+        modified."""
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if self.filenames is None or mtime != self.mtime:
+            self.filenames = self.scan()
+            self.mtime = mtime
+        return self.filenames
+
+    def generate(self):
+        return random.choice(self.get_filenames())
+
+    def generate_values(self, n):
+        filenames = self.get_filenames()
+        if not filenames:
+            raise IndexError("no files to choose from in %s" % self.path)
+        return [filenames[i]
+                for i in random_integers(0, len(filenames) - 1, n)]
 
 
 class MediaFilePathGenerator(FilePathGenerator):
@@ -465,11 +940,11 @@ class MediaFilePathGenerator(FilePathGenerator):
         path = os.path.join(settings.MEDIA_ROOT, path)
         super(MediaFilePathGenerator, self).__init__(path, *args, **kwargs)
 
-    def generate(self):
+    def scan(self):
         from django.conf import settings
-        filename = super(MediaFilePathGenerator, self).generate()
-        filename = relpath(filename, settings.MEDIA_ROOT)
-        return filename
+        filenames = super(MediaFilePathGenerator, self).scan()
+        return [relpath(filename, settings.MEDIA_ROOT)
+                for filename in filenames]
 
 
 # TODO: try to get this thing out of here
@@ -520,11 +995,19 @@ class MultipleInstanceGenerator(InstanceGenerator):
 class InstanceSelector(Generator):
     '''
     Select one or more instances from a queryset.
+
+    The primary keys of the queryset are loaded once and sampled in memory,
+    the chosen objects are then fetched with ``in_bulk``, in as few queries
+    as the database allows.
+    Call ``refresh`` to load the primary keys again. If ``refresh_after`` is
+    given, primary keys newer than the cached ones are fetched once
+    ``inserted`` has reported that many new rows.
     '''
     empty_value = []
 
     def __init__(self, queryset, min_count=None, max_count=None, fallback=None,
-        limit_choices_to=None, *args, **kwargs):
+        limit_choices_to=None, replace=False, refresh_after=None,
+        *args, **kwargs):
         from django.db.models.query import QuerySet
         from django.db.models import Q
         if not isinstance(queryset, QuerySet):
@@ -537,18 +1020,84 @@ class InstanceSelector(Generator):
         self.fallback = fallback
         self.min_count = min_count
         self.max_count = max_count
+        self.replace = replace
+        self.refresh_after = refresh_after
+        self.refresh()
         super(InstanceSelector, self).__init__(*args, **kwargs)
 
+    def refresh(self):
+        """Discards the cached primary keys."""
+
+        self.pks = None
+        self.inserts = 0
+
+    def load_pks(self, queryset):
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+        if all(isinstance(pk, (int, long)) for pk in pks):
+            try:
+                return array.array('l', pks)
+            except OverflowError:
+                pass
+        return pks
+
+    def get_pks(self):
+        """Returns the cached primary keys, sorted."""
+
+        if self.pks is None:
+            self.pks = self.load_pks(self.queryset)
+            self.inserts = 0
+        elif self.refresh_after and self.inserts >= self.refresh_after:
+            queryset = self.queryset
+            if self.pks:
+                queryset = queryset.filter(pk__gt=self.pks[-1])
+            self.pks.extend(self.load_pks(queryset))
+            self.inserts = 0
+        return self.pks
+
+    def inserted(self, count=1):
+        """Reports that count rows were added to the queryset."""
+
+        self.inserts += count
+
+    def sample(self, count):
+        """Returns count primary keys chosen at random."""
+
+        pks = self.get_pks()
+        if not pks:
+            return []
+        if self.replace:
+            return [pks[i] for i in random_integers(0, len(pks) - 1, count)]
+        return random.sample(pks, min(count, len(pks)))
+
+    def select(self, count):
+        """Returns a list with count objects chosen at random."""
+
+        from django.db import connections
+        from models import get_batch_size
+
+        pks = self.sample(count)
+        unique_pks = list(set(pks))
+        batch_size = get_batch_size(connections[self.queryset.db], [None])
+
+        objs = {}
+        for start in xrange(0, len(unique_pks), batch_size):
+            objs.update(self.queryset.in_bulk(
+                unique_pks[start:start + batch_size]))
+        if len(objs) < len(unique_pks):
+            # some rows were deleted, load the primary keys again
+            self.refresh()
+        return [objs[pk] for pk in pks if pk in objs]
+
     def generate(self):
         if self.max_count is None:
-            try:
-                return self.queryset.order_by('?')[0]
-            except IndexError:
+            objs = self.select(1) or self.select(1)
+            if not objs:
                 return self.fallback
+            return objs[0]
         else:
             min_count = self.min_count or 0
             count = random.randint(min_count, self.max_count)
-            return self.queryset.order_by('?')[:count]
+            return self.select(count)
 
 
 #
@@ -570,6 +1119,11 @@ class FieldGenerator(Generator):
             self._generator = self.get_generator(self.field, **self.kwargs)
         return self._generator.generate()
 
+    def generate_values(self, n):
+        if not hasattr(self, '_generator'):
+            self._generator = self.get_generator(self.field, **self.kwargs)
+        return self._generator.generate_values(n)
+
 
 class ChoiceFieldGenerator(FieldGenerator):
     def get_generator(self, field, *args, **kwargs):
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import datetime
+from cStringIO import StringIO
+
+from django.db import connections, router, transaction
+from django.db.models import Model
+from django.db.models.fields import AutoField, NOT_PROVIDED
+from django.db.models.fields.related import ForeignKey
+
+from models import Mockup, MockupData, get_batch_size
+
+
+class InsertEngine(object):
+    """Inserts mockup rows of a model with raw queries.
+
+    Rows are turned into tuples of column values without instantiating the
+    model, and written in chunks: with COPY FROM STDIN on PostgreSQL, with
+    multi-row VALUES on sqlite and with executemany on other backends.
+
+    When the mockup of the model doesn't customise mockup_data and the model
+    has no unique_together constraints, whole columns are generated at once
+    with Generator.get_values. Otherwise every row goes through
+    Mockup.fill_mockup_data, so customisations still apply.
+
+    Objects are not saved through the ORM, so save signals are not sent and
+    fields such as auto_now keep their generated values.
+
+    """
+
+    chunk_size = 1000
+
+    def __init__(self, factory, model_class, using=None, chunk_size=None):
+        self.factory = factory
+        self.mockup = factory[model_class]
+        self.model_class = model_class
+        self.using = using or router.db_for_write(model_class)
+        if chunk_size is not None:
+            if chunk_size < 1:
+                raise ValueError("chunk_size must be at least 1")
+            self.chunk_size = chunk_size
+        self.table = model_class._meta.db_table
+
+    def get_columns(self, force):
+        """Returns the fields having a column in the inserted rows."""
+
+        return [field for field in self.model_class._meta.local_fields
+                if not isinstance(field, AutoField) or field.name in force]
+
+    def use_columns(self):
+        """Tells whether values can be generated a column at a time."""
+
+        mockup_data = getattr(type(self.mockup).mockup_data, 'im_func', None)
+        return (mockup_data is Mockup.mockup_data.im_func and
+                not self.model_class._meta.unique_together)
+
+    def insert(self, n, **kwargs):
+        """Inserts n rows. kwargs are forced values, as in Mockup.create.
+        Returns the number of inserted rows."""
+
+        if self.model_class._meta.parents:
+            # rows of multi-table inherited models span several tables
+            self.mockup.create_batch(n, **kwargs)
+            return n
+
+        plan = self.mockup.get_plan()
+        if any(name in kwargs for name in plan.tomany_fields):
+            raise ValueError("To-many relationships can't be inserted")
+
+        columns = self.get_columns(kwargs)
+        for count in self.get_chunk_sizes(n, columns):
+            if self.use_columns():
+                rows = self.generate_columns(count, columns, kwargs)
+            else:
+                rows = self.generate_rows(count, columns, kwargs)
+            self.write(columns, self.prepare(columns, rows))
+
+        return n
+
+    def get_chunk_sizes(self, n, columns):
+        connection = connections[self.using]
+        size = self.chunk_size
+        if connection.vendor == 'sqlite':
+            size = min(size, get_batch_size(connection, columns))
+
+        while n > 0:
+            yield min(n, size)
+            n -= size
+
+    def generate_columns(self, n, columns, force):
+        """Returns n rows generating the values of each column at once."""
+
+        values = []
+        for field in columns:
+            if field.name in force:
+                values.append([force[field.name]] * n)
+            elif isinstance(field, ForeignKey):
+                values.append(self.factory.get_related_many(field.rel.to, n))
+            elif field.default is not NOT_PROVIDED:
+                if callable(field.default):
+                    values.append([field.default() for x in xrange(n)])
+                else:
+                    values.append([field.default] * n)
+            else:
+                values.append(self.generate_values(field, n))
+        return zip(*values)
+
+    def generate_values(self, field, n):
+        try:
+            generator = self.factory.get_generator(field)
+        except KeyError:
+            msg = "Could not mockup data for %s.%s %s"
+            msg %= (self.model_class.__name__, field.name, type(field))
+            raise Exception(msg)
+
+        values = generator.get_values(n)
+        if field.unique:
+            unique_value = self.factory.get_unique_values(
+                field.model, [field.name]).unique_value
+            values = [value if value is None else
+                      unique_value(value, generator.get_value)
+                      for value in values]
+        return values
+
+    def generate_rows(self, n, columns, force):
+        """Returns n rows obtained from the mockup of the model."""
+
+        plan = self.mockup.get_plan()
+        datas = []
+        for x in xrange(n):
+            model_data = MockupData(force=force, factory=self.factory,
+                                    defer_related=True, plan=plan)
+            datas.append(self.mockup.fill_mockup_data(model_data))
+
+        self.mockup.create_deferred_related(datas)
+
+        rows = []
+        for model_data in datas:
+            data = model_data.data
+            rows.append(tuple(data[field.name] if field.name in data
+                              else field.get_default() for field in columns))
+        return rows
+
+    def prepare(self, columns, rows):
+        """Converts the values of rows to the ones stored in the database."""
+
+        connection = connections[self.using]
+        preps = [field.get_db_prep_save for field in columns]
+
+        prepared = []
+        for row in rows:
+            prepared.append(tuple(
+                prep(value.pk if isinstance(value, Model) else value,
+                     connection=connection)
+                for prep, value in zip(preps, row)))
+        return prepared
+
+    def write(self, columns, rows):
+        connection = connections[self.using]
+        quote_name = connection.ops.quote_name
+        table = quote_name(self.table)
+        names = [quote_name(field.column) for field in columns]
+
+        cursor = connection.cursor()
+        if connection.vendor == 'postgresql':
+            cursor.copy_from(StringIO(copy_data(rows)), table,
+                             columns=names)
+        elif connection.vendor == 'sqlite':
+            row_sql = u'(%s)' % u', '.join([u'%s'] * len(names))
+            sql = u'INSERT INTO %s (%s) VALUES %s' % (
+                table, u', '.join(names), u', '.join([row_sql] * len(rows)))
+            cursor.execute(sql, [value for row in rows for value in row])
+        else:
+            sql = u'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, u', '.join(names), u', '.join([u'%s'] * len(names)))
+            cursor.executemany(sql, rows)
+
+        transaction.commit_unless_managed(using=self.using)
+
+
+def copy_value(value):
+    """Formats a value for the text format of PostgreSQL's COPY."""
+
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_data(rows):
+    """Returns rows in the text format of PostgreSQL's COPY."""
+
+    return ''.join('\t'.join(copy_value(value) for value in row) + '\n'
+                   for row in rows)
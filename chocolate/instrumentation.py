@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from django.db import connections
+
+
+class Span(object):
+    """A timed step of the creation of mockups, reported to the hooks of a
+    factory when it starts and ends.
+
+    event is one of:
+
+    - "mockup_data": values of objects of model are being obtained.
+    - "generate": a value is being generated for field of model.
+    - "related": objects of model are being obtained for the foreign key
+      name, of another model.
+    - "save": count objects of model are being saved.
+    - "tomany": the to-many relationship name of objects of model is being
+      created.
+
+    """
+
+    def __init__(self, hooks, event, model, field=None, count=0, name=None):
+        self.hooks = hooks
+        self.event = event
+        self.model = model
+        self.field = field
+        self.count = count
+        self.name = name
+
+    def __enter__(self):
+        for hook in self.hooks:
+            hook.start(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for hook in reversed(self.hooks):
+            hook.end(self)
+
+
+class NullSpan(object):
+    """Span used when a factory has no hooks."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def count_queries():
+    return sum(len(connection.queries) for connection in connections.all())
+
+
+def enable_query_log():
+    """Makes every connection record its queries. Returns the previous
+    settings for restore_query_log."""
+
+    states = [(connection, connection.use_debug_cursor)
+              for connection in connections.all()]
+    for connection, state in states:
+        connection.use_debug_cursor = True
+    return states
+
+
+def restore_query_log(states):
+    for connection, state in states:
+        connection.use_debug_cursor = state
+
+
+def get_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+class Counters(object):
+    """Hook counting objects, queries and time by model and generator.
+
+    Time and queries of a span exclude those of the spans nested in it, so
+    the time spent creating the parents of an object is counted for the
+    parent model only. Queries are only counted while the debug cursor of
+    the connections is enabled, see ModelFactory.measure.
+
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.generators = {}
+        self.stack = []
+
+    def get_model_counters(self, model):
+        try:
+            return self.models[model]
+        except KeyError:
+            counters = self.models[model] = {
+                'objects': 0, 'queries': 0, 'seconds': {}}
+            return counters
+
+    def start(self, span):
+        # [span, start time, queries, seconds and queries of nested spans]
+        self.stack.append([span, time.time(), count_queries(), 0.0, 0])
+
+    def end(self, span):
+        span, start, queries, nested_seconds, nested_queries = \
+            self.stack.pop()
+        seconds = time.time() - start
+        queries = count_queries() - queries
+        if self.stack:
+            self.stack[-1][3] += seconds
+            self.stack[-1][4] += queries
+
+        counters = self.get_model_counters(span.model)
+        counters['objects'] += span.count
+        counters['queries'] += queries - nested_queries
+        event_seconds = counters['seconds']
+        event_seconds[span.event] = (event_seconds.get(span.event, 0) +
+                                     seconds - nested_seconds)
+
+        if span.event == 'generate':
+            key = (span.model, span.field.name)
+            values, total = self.generators.get(key, (0, 0))
+            self.generators[key] = (values + 1, total + seconds)
+
+    def snapshot(self):
+        """Returns the counters as a dict."""
+
+        models = {}
+        for model, counters in self.models.items():
+            models[get_label(model)] = {
+                'objects': counters['objects'],
+                'queries': counters['queries'],
+                'seconds': dict(counters['seconds']),
+            }
+
+        generators = {}
+        for (model, name), (values, seconds) in self.generators.items():
+            generators['%s.%s' % (get_label(model), name)] = {
+                'values': values, 'seconds': seconds}
+
+        return {'models': models, 'generators': generators}
+
+
+class Measurement(object):
+    """Context manager counting what a factory does inside its block with
+    a new Counters hook, which is returned by __enter__."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.counters = Counters()
+        self.states = None
+
+    def __enter__(self):
+        self.states = enable_query_log()
+        self.factory.add_hook(self.counters)
+        return self.counters
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.factory.remove_hook(self.counters)
+        restore_query_log(self.states)
+
+
+class TraceNode(object):
+    """A span recorded by Trace."""
+
+    def __init__(self, event=None, model=None, name=None):
+        self.event = event
+        self.model = model
+        self.name = name
+        self.rows = 0
+        self.seconds = 0.0
+        self.start = None
+        self.children = []
+
+    def get_frame(self):
+        """Returns the name of the node in folded stacks."""
+
+        frame = '%s:%s' % (get_label(self.model), self.event)
+        if self.name:
+            frame += '(%s)' % self.name
+        return frame
+
+    def get_rows(self):
+        """Returns the rows saved by this node and its descendants."""
+
+        return self.rows + sum(child.get_rows() for child in self.children)
+
+    def to_dict(self):
+        return {
+            'event': self.event,
+            'model': get_label(self.model),
+            'name': self.name,
+            'rows': self.get_rows(),
+            'seconds': self.seconds,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+    def fold(self, stack, lines):
+        stack = stack + [self.get_frame()]
+        own = self.seconds - sum(child.seconds for child in self.children)
+        lines.append('%s %d' % (';'.join(stack), max(0, own) * 1000000))
+        for child in self.children:
+            child.fold(stack, lines)
+
+
+class Trace(object):
+    """Hook recording the tree of the spans of the creation of mockups, such
+    as the parents created for the foreign keys of an object and the objects
+    of its to-many relationships. "generate" spans are not recorded, their
+    time is part of the span that called the generator.
+
+    >>> with factory.trace() as trace:
+    ...     factory[Comment].create()
+    >>> trace.to_json()
+
+    """
+
+    def __init__(self):
+        self.roots = []
+        self.stack = []
+
+    def start(self, span):
+        if span.event == 'generate':
+            return
+
+        node = TraceNode(span.event, span.model, span.name)
+        if self.stack:
+            self.stack[-1].children.append(node)
+        else:
+            self.roots.append(node)
+        self.stack.append(node)
+        node.start = time.time()
+
+    def end(self, span):
+        if span.event == 'generate':
+            return
+
+        node = self.stack.pop()
+        node.seconds = time.time() - node.start
+        node.rows = span.count
+
+    def to_dict(self):
+        return [root.to_dict() for root in self.roots]
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_folded(self):
+        """Returns the trace as folded stacks, one line per node with its
+        own time in microseconds, as read by flame graph tools."""
+
+        lines = []
+        for root in self.roots:
+            root.fold([], lines)
+        return '\n'.join(lines) + '\n'
+
+
+class Tracing(object):
+    """Context manager recording with a new Trace hook what a factory does
+    inside its block."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.trace = Trace()
+
+    def __enter__(self):
+        self.factory.add_hook(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.factory.remove_hook(self.trace)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryBudget(object):
+    """Context manager failing with QueryBudgetExceeded when more than
+    budget queries are issued inside its block. The message breaks the
+    queries down by model and lists their SQL."""
+
+    # longer statements are cut in the message
+    max_sql_length = 200
+
+    def __init__(self, factory, budget):
+        self.factory = factory
+        self.budget = budget
+        self.counters = Counters()
+        self.states = None
+        self.starts = None
+
+    def __enter__(self):
+        self.states = enable_query_log()
+        self.starts = [(connection, len(connection.queries))
+                       for connection in connections.all()]
+        self.factory.add_hook(self.counters)
+        return self
+
+    def get_queries(self):
+        queries = []
+        for connection, start in self.starts:
+            queries.extend(query['sql']
+                           for query in connection.queries[start:])
+        return queries
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.factory.remove_hook(self.counters)
+        queries = self.get_queries()
+        restore_query_log(self.states)
+
+        if exc_type is None and len(queries) > self.budget:
+            raise QueryBudgetExceeded(self.get_message(queries))
+
+    def get_message(self, queries):
+        lines = ['%d queries issued, the budget is %d.' % (
+            len(queries), self.budget)]
+
+        models = self.counters.snapshot()['models']
+        counts = sorted((counters['queries'], label)
+                        for label, counters in models.items()
+                        if counters['queries'])
+        if counts:
+            lines.append('By model: %s' % ', '.join(
+                '%s %d' % (label, count) for count, label in reversed(counts)))
+
+        lines.append('Queries:')
+        for i, sql in enumerate(queries):
+            if len(sql) > self.max_sql_length:
+                sql = sql[:self.max_sql_length] + '...'
+            lines.append('%d. %s' % (i + 1, sql))
+        return '\n'.join(lines)
@@ -0,0 +1,94 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from chocolate.benchmarks import check_budgets, get_environment
+from chocolate.benchmarks import run_benchmarks
+from chocolate.specs import SpecError, load_spec
+
+
+class Command(BaseCommand):
+    args = '<benchmark.json|benchmark.py>'
+    help = ('Runs the benchmarks described by a spec on a new test database '
+            'and writes their results as JSON. Fails if a model exceeds its '
+            'query budget.')
+    option_list = BaseCommand.option_list + (
+        make_option('--output', action='store', dest='output', default=None,
+                    help='File the results are written to, instead of '
+                         'the standard output.'),
+        make_option('--repeat', action='store', dest='repeat', type='int',
+                    default=None, help='Overrides the repeat of the spec.'),
+        make_option('--sqlite-file', action='store', dest='sqlite_file',
+                    default=None,
+                    help='With sqlite, runs the benchmarks again on a '
+                         'database stored in this file.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: chocolate_benchmark %s' % self.args)
+
+        try:
+            spec = load_spec(args[0])
+        except (IOError, ValueError), e:
+            raise CommandError(e)
+        if options['repeat'] is not None:
+            spec['repeat'] = options['repeat']
+
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor == 'sqlite':
+            databases = [('memory', ':memory:')]
+            if options['sqlite_file']:
+                databases.append(('file', options['sqlite_file']))
+        else:
+            databases = [(connection.vendor, None)]
+
+        results = {}
+        for name, test_name in databases:
+            try:
+                results[name] = self.run(spec, test_name)
+            except SpecError, e:
+                raise CommandError(e)
+
+        output = json.dumps({'environment': get_environment(),
+                             'results': results}, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output)
+        else:
+            self.stdout.write(output + '\n')
+
+        exceeded = []
+        for name, database_results in sorted(results.items()):
+            exceeded.extend('%s: %s' % (name, message) for message in
+                            check_budgets(spec.get('budgets', {}),
+                                          database_results))
+        if exceeded:
+            raise CommandError('Query budgets exceeded:\n' +
+                               '\n'.join(exceeded))
+
+    def run(self, spec, test_name):
+        """Runs the benchmarks on a test database named test_name."""
+
+        connection = connections[DEFAULT_DB_ALIAS]
+        old_name = connection.settings_dict['NAME']
+        old_test_name = connection.settings_dict.get('TEST_NAME')
+
+        connection.settings_dict['TEST_NAME'] = test_name
+        self.disconnect(connection)
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            return run_benchmarks(spec)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            connection.settings_dict['TEST_NAME'] = old_test_name
+            self.disconnect(connection)
+
+    def disconnect(self, connection):
+        # sqlite ignores close() on in-memory databases, which would keep
+        # the previous database in use
+        if connection.connection is not None:
+            connection.connection.close()
+            connection.connection = None
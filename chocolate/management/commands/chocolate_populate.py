@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chocolate.models import BATCH_SIZE
+from chocolate.specs import Dataset, SpecError, load_spec
+
+
+class Command(BaseCommand):
+    args = '<spec.json|spec.py>'
+    help = 'Populates the database with the mockup objects described by a spec.'
+    option_list = BaseCommand.option_list + (
+        make_option('--scale', action='store', dest='scale', type='float',
+                    default=1, help='Multiplies every count of the spec.'),
+        make_option('--seed', action='store', dest='seed', type='int',
+                    default=None, help='Seeds the generated values.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+                    type='int', default=BATCH_SIZE,
+                    help='Objects created with each batch of inserts.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: chocolate_populate %s' % self.args)
+
+        self.verbosity = int(options.get('verbosity', 1))
+
+        try:
+            spec = load_spec(args[0])
+            if options['seed'] is not None:
+                spec['seed'] = options['seed']
+            dataset = Dataset(spec, scale=options['scale'],
+                              report=self.report)
+            dataset.chunk_size = options['chunk_size']
+            dataset.run()
+        except (IOError, ValueError, SpecError), e:
+            raise CommandError(e)
+
+    def report(self, model_class, created, total, seconds):
+        if self.verbosity < 1 or (self.verbosity < 2 and created < total):
+            return
+
+        opts = model_class._meta
+        rate = created / seconds if seconds else float(created)
+        self.stdout.write('%s.%s: %d/%d rows, %.0f rows/s\n' % (
+            opts.app_label, opts.object_name, created, total, rate))
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
+import datetime
 import types
+from decimal import Decimal
 
-from django.contrib.contenttypes.models import ContentType
 from django.db.models.fields import NOT_PROVIDED
 from django.db.models.fields.related import ManyToManyField, ForeignKey
 from django.db.models.fields.related import ManyRelatedObjectsDescriptor
 from django.db.models.fields.related import ForeignRelatedObjectsDescriptor
-from django.db import models
+from django.db import models, connections, router, transaction
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.fields import AutoField
 
 import generators
+from instrumentation import NULL_SPAN, Span, Counters, Measurement, Tracing
+from instrumentation import QueryBudget
+from instrumentation import enable_query_log, restore_query_log
 
 
 FIELDCLASS_TO_GENERATOR = {
@@ -35,6 +41,10 @@ FIELDCLASS_TO_GENERATOR = {
 }
 
 
+# maximum number of rows per insert query for backends other than sqlite
+BATCH_SIZE = 1000
+
+
 class UnregisteredModel(Exception):
     pass
 
@@ -52,17 +62,711 @@ def get_field_from_related_name(model_class, related_name):
     return None
 
 
-class ModelFactory(object):
+def make_generator(field):
+    """Returns a new generator of values for a django model field."""
+
+    generator_class = FIELDCLASS_TO_GENERATOR[type(field)]
+    if issubclass(generator_class, generators.FieldGenerator):
+        return generator_class(field)
+    return generator_class()
+
+
+def get_model_fields(model_class):
+    """Obtains a list of fields of the given model class separated
+    between to-many and non-to-many (regular)"""
+
+    many = []
+    regular = []
+
+    class_fields = model_class._meta.get_all_field_names()
+    for field in class_fields:
+        try:
+            field_obj = model_class._meta.get_field(field)
+            is_tomany = isinstance(field_obj, ManyToManyField)
+        except Exception:
+            try:
+                field_obj = getattr(model_class, field)
+                is_tomany = isinstance(
+                    field_obj,
+                    ForeignRelatedObjectsDescriptor)
+                is_tomany = is_tomany or isinstance(
+                    field_obj, ManyRelatedObjectsDescriptor)
+            except AttributeError:
+                #probably a to-many field with no reverse relationship
+                #defined
+                continue
+
+        if is_tomany:
+            many.append(field)
+        else:
+            regular.append(field)
+
+    return many, regular
+
+
+class TomanyRelation(object):
+    """Describes how to create the objects of a to-many relationship."""
+
+    def __init__(self, model_class, name):
+        self.name = name
+
+        descriptor = getattr(model_class, name)
+        if isinstance(descriptor, ForeignRelatedObjectsDescriptor):
+            self.related_model = descriptor.related.model
+            self.through = None
+        elif isinstance(descriptor, ManyRelatedObjectsDescriptor):
+            self.related_model = descriptor.related.model
+            self.through = descriptor.related.field.rel.through
+        else:
+            self.related_model = descriptor.field.rel.to
+            self.through = descriptor.field.rel.through
+
+        # foreign key of the related model pointing back to model_class
+        self.reverse_field = get_field_from_related_name(
+            self.related_model, name)
+
+        # foreign keys of the through model, paired with True when they
+        # point to model_class and False when they point to related_model
+        self.through_fields = []
+        if self.through is not None:
+            for field in self.through._meta.fields:
+                if isinstance(field, ForeignKey):
+                    if issubclass(model_class, field.rel.to):
+                        self.through_fields.append((field.name, True))
+                    elif issubclass(self.related_model, field.rel.to):
+                        self.through_fields.append((field.name, False))
+
+    def get_through_data(self, model, value):
+        """Returns the values of a through model object linking model to
+        value."""
+
+        data = {}
+        for name, is_model in self.through_fields:
+            data[name] = model if is_model else value
+        return data
+
+
+class MockupPlan(object):
+    """Introspection of a model class needed to create mockups of it.
+
+    Plans are compiled once per model and kept by the Mockup until the
+    registry of its factory changes.
+
+    """
+
+    def __init__(self, model_class, version=None):
+        self.model_class = model_class
+        self.version = version
+
+        self.tomany_fields, self.regular_fields = get_model_fields(model_class)
+
+        self.tomany = {}
+        for name in self.tomany_fields:
+            self.tomany[name] = TomanyRelation(model_class, name)
+
+        # (field, related model of foreign keys, generator class) tuples
+        self.fields = []
+        for field in model_class._meta.fields:
+            if isinstance(field, ForeignKey):
+                self.fields.append((field, field.rel.to, None))
+            else:
+                generator_class = FIELDCLASS_TO_GENERATOR.get(type(field))
+                self.fields.append((field, None, generator_class))
+
+        # fields whose forced values are tracked as taken unique values
+        self.unique_fields = set(
+            field.name for field in model_class._meta.fields
+            if field.unique and not isinstance(field, (ForeignKey, AutoField)))
+
+        opts = model_class._meta
+        self.unique_together = [
+            (field_names, [opts.get_field(name) for name in field_names])
+            for field_names in opts.unique_together]
+
+
+def get_batch_size(connection, fields):
+    """Returns how many rows can be inserted with a single query."""
+
+    if connection.vendor == 'sqlite':
+        # sqlite limits both the number of query parameters and the number
+        # of terms in the compound select used for bulk inserts.
+        return max(1, min(500, 999 // max(1, len(fields))))
+    return BATCH_SIZE
+
+
+def bulk_insert(model_class, objs, using=None):
+    """Inserts the given unsaved instances using as few queries as possible.
+
+    Primary keys of auto generated fields are filled in by reading back the
+    rows above the highest key found before each insert, inside the same
+    transaction. GeneratorException is raised when the rows read back are not
+    the inserted ones, as happens when another process inserts into that
+    table at the same time.
+
+    """
+
+    using = using or router.db_for_write(model_class)
+
+    if model_class._meta.parents:
+        # django can't bulk insert into multi-table inherited models
+        for obj in objs:
+            obj.save(using=using)
+        return objs
+
+    connection = connections[using]
+    manager = model_class._base_manager.db_manager(using)
+    batch_size = get_batch_size(connection, model_class._meta.local_fields)
+    auto_pk = isinstance(model_class._meta.pk, AutoField)
+
+    with_pk = [obj for obj in objs if obj.pk is not None]
+    without_pk = [obj for obj in objs if obj.pk is None]
+
+    for chunk in chunked(with_pk, batch_size):
+        manager.bulk_create(chunk)
+
+    for chunk in chunked(without_pk, batch_size):
+        if not auto_pk:
+            manager.bulk_create(chunk)
+            continue
+
+        with Atomic(using):
+            last = manager.aggregate(last=models.Max('pk'))['last'] or 0
+            manager.bulk_create(chunk)
+            pks = list(manager.filter(pk__gt=last).order_by('pk')
+                       .values_list('pk', flat=True))
+            if len(pks) != len(chunk):
+                # rolls the insert back
+                raise generators.GeneratorException(
+                    'Expected %d new rows of %s, found %d.' % (
+                        len(chunk), model_class.__name__, len(pks)))
+        for obj, pk in zip(chunk, pks):
+            obj.pk = pk
+
+    return objs
+
+
+# derived float values are multiples of 1 / FLOAT_SCALE
+FLOAT_SCALE = 10 ** 6
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# values integer fields can store, the most specific classes come first
+INTEGER_BOUNDS = [
+    (models.PositiveSmallIntegerField, (0, 2 ** 15 - 1)),
+    (models.SmallIntegerField, (-2 ** 15, 2 ** 15 - 1)),
+    (models.PositiveIntegerField, (0, 2 ** 31 - 1)),
+    (models.BigIntegerField, (-2 ** 63, 2 ** 63 - 1)),
+    (models.IntegerField, (-2 ** 31, 2 ** 31 - 1)),
+]
+
+
+def get_position(value, field):
+    """Returns the integer position of value among the values of field that
+    can be derived, or None if values of its type can't be derived.
+
+    Positions keep the order of the values: dates count days, datetimes and
+    times count seconds and decimals count units of their last place.
+
+    """
+
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, Decimal):
+        places = getattr(field, 'decimal_places', None)
+        if places is None:
+            places = -value.as_tuple().exponent
+        return int(value.scaleb(places).to_integral_value())
+    if isinstance(value, float):
+        return int(round(value * FLOAT_SCALE))
+    if isinstance(value, datetime.datetime):
+        delta = value.replace(tzinfo=None) - EPOCH
+        return delta.days * 86400 + delta.seconds
+    if isinstance(value, datetime.date):
+        return value.toordinal()
+    if isinstance(value, datetime.time):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    return None
+
+
+def from_position(position, value, field):
+    """Returns the value of field at position, of the same type as value."""
+
+    if isinstance(value, (int, long)):
+        return position
+    if isinstance(value, Decimal):
+        places = getattr(field, 'decimal_places', None)
+        if places is None:
+            places = -value.as_tuple().exponent
+        return Decimal(position).scaleb(-places)
+    if isinstance(value, float):
+        return float(position) / FLOAT_SCALE
+    if isinstance(value, datetime.datetime):
+        derived = EPOCH + datetime.timedelta(seconds=position)
+        return derived.replace(tzinfo=value.tzinfo)
+    if isinstance(value, datetime.date):
+        return datetime.date.fromordinal(position)
+    minutes, seconds = divmod(position, 60)
+    return datetime.time(minutes // 60, minutes % 60, seconds)
+
+
+def get_bounds(value, field):
+    """Returns the lowest and highest positions field can store, None when
+    unbounded."""
+
+    if isinstance(value, (int, long)):
+        for field_class, bounds in INTEGER_BOUNDS:
+            if isinstance(field, field_class):
+                return bounds
+    elif isinstance(value, Decimal) and getattr(field, 'max_digits', None):
+        highest = 10 ** field.max_digits - 1
+        return -highest, highest
+    elif isinstance(value, datetime.datetime):
+        return (get_position(datetime.datetime.min, field),
+                get_position(datetime.datetime.max, field))
+    elif isinstance(value, datetime.date):
+        return 1, datetime.date.max.toordinal()
+    elif isinstance(value, datetime.time):
+        return 0, 24 * 3600 - 1
+    return None, None
+
+
+class UniqueValues(object):
+    """Keeps track of the values taken by a unique field, or by a group of
+    unique_together fields.
+
+    The values are loaded from the database the first time they are needed,
+    after that every candidate is checked in memory. Values are stored as
+    tuples with related objects replaced by their primary keys.
+
+    With a partition, generated candidates are only accepted if they belong
+    to it, and derived values are taken from a sequence no other partition
+    uses: numbers, dates and times at a position equal to the index of the
+    partition modulo their count, strings with such a suffix.
+
+    """
+
+    # regenerations allowed before deriving values
+    max_attempts = 10
+
+    def __init__(self, model_class, fields, partition=None):
+        self.model_class = model_class
+        self.fields = fields
+        # (index, count) of the share of values this tracker may claim
+        self.partition = partition
+        self.values = None
+        self.seeded = False
+        # values derived so far from each value
+        self.derived = {}
+
+    def seed(self):
+        """Loads the values already stored in the database. Returns them."""
+
+        attnames = [field.attname for field in self.fields]
+        queryset = self.model_class._base_manager.values_list(*attnames)
+        stored = set(tuple(row) for row in queryset)
+        if self.values is not None:
+            self.values |= stored
+        else:
+            self.values = set(stored)
+        self.seeded = True
+        return stored
+
+    def get_key(self, values):
+        return tuple(value.pk if isinstance(value, models.Model) else value
+                     for value in values)
+
+    def add(self, values, seed=True):
+        """Marks the tuple of values as taken. Returns False if they already
+        were. If seed is False the database is not queried, values are only
+        checked against the ones tracked so far."""
+
+        if seed and not self.seeded:
+            self.seed()
+        elif self.values is None:
+            self.values = set()
+
+        key = self.get_key(values)
+        if key in self.values:
+            return False
+
+        self.values.add(key)
+        return True
+
+    def in_partition(self, values):
+        """Tells whether the tuple of values belongs to the partition of
+        this tracker."""
+
+        if self.partition is None:
+            return True
+
+        index, count = self.partition
+        key = self.get_key(values)
+        if len(key) > 1:
+            return hash(key) % count == index
+
+        position = get_position(key[0], self.fields[0])
+        if position is None:
+            position = hash(key[0])
+        return position % count == index
+
+    def claim(self, values, seed=True):
+        """Like add, but values outside the partition are refused too."""
+
+        return self.in_partition(values) and self.add(values, seed)
+
+    def unique_value(self, value, generate, seed=True):
+        """Returns value or a replacement for it that was not taken yet.
+
+        generate is called to obtain new candidates, once max_attempts is
+        reached candidates are derived from the last one instead.
+
+        """
+
+        attempts = 1
+        while not self.claim((value,), seed):
+            if attempts == self.max_attempts:
+                base = value
+                value = self.derive(base, self.fields[0])
+                while not self.add((value,), seed):
+                    value = self.derive(base, self.fields[0])
+                break
+            value = generate()
+            attempts += 1
+        return value
+
+    def derive(self, value, field):
+        """Returns the next candidate for field derived from value, always
+        within the partition and the range of the field. Raises
+        GeneratorException if values of its type can't be derived."""
+
+        index, count = self.partition or (0, 1)
+        n = self.derived.get(value, 0)
+
+        if isinstance(value, basestring):
+            self.derived[value] = n + 1
+            suffix = u'-%d' % (index + n * count)
+            if field.max_length:
+                if len(suffix) >= field.max_length:
+                    msg = "No room for a unique suffix in %s.%s"
+                    msg %= (self.model_class.__name__, field.name)
+                    raise generators.GeneratorException(msg)
+                value = value[:field.max_length - len(suffix)]
+            return value + suffix
+
+        position = get_position(value, field)
+        if position is not None:
+            low, high = get_bounds(value, field)
+            # the closest position of the partition not above value
+            start = position - (position - index) % count
+            while True:
+                # start, start + count, start - count, start + 2 * count...
+                steps = (n + 1) // 2 if n % 2 else -(n // 2)
+                candidate = start + steps * count
+                n += 1
+                below = low is not None and candidate < low
+                above = high is not None and candidate > high
+                if not below and not above:
+                    self.derived[value] = n
+                    return from_position(candidate, value, field)
+
+                distance = abs(steps) * count
+                if (low is not None and start - distance < low and
+                        high is not None and start + distance > high):
+                    break
+
+        msg = "Could not obtain a unique value for %s.%s"
+        msg %= (self.model_class.__name__, field.name)
+        raise generators.GeneratorException(msg)
+
+
+def create_tomany(factory, plan, items):
+    """Creates the to-many relationships of saved objects of plan.model_class
+
+    items is a list of (object, MockupData) pairs. Related objects and through
+    model rows are created in batches, so the number of queries doesn't
+    depend on the number of related objects.
+
+    """
+
+    for name in plan.tomany_fields:
+        relation = plan.tomany[name]
+
+        # (object, related object) pairs to be linked
+        links = []
+        # forced values and objects of the related objects to be created
+        forces = []
+        owners = []
+
+        for obj, model_data in items:
+            try:
+                values = model_data[name]
+            except KeyError:
+                continue
+
+            if type(values) is int:
+                if relation.reverse_field is None:
+                    data = {}
+                else:
+                    data = {relation.reverse_field.name: obj}
+                forces.extend([data] * values)
+                owners.extend([obj] * values)
+            else:
+                if type(values) is not list:
+                    values = [values]
+                links.extend((obj, value) for value in values)
+
+        if forces or links:
+            with factory.span('tomany', plan.model_class, name=name):
+                link_tomany(factory, relation, name, links, forces, owners)
+
+
+def link_tomany(factory, relation, name, links, forces, owners):
+    """Links the (object, related object) pairs in links through the
+    to-many relation name, creating first one related object for each dict
+    of forced values in forces, linked to the object at the same position
+    in owners."""
+
+    if forces:
+        created = factory[relation.related_model].create_many(forces)
+        if relation.through is not None or relation.reverse_field is None:
+            links.extend(zip(owners, created))
+
+    if not links:
+        return
+
+    if relation.through is not None:
+        factory[relation.through].create_many(
+            [relation.get_through_data(obj, value)
+             for obj, value in links])
+    elif relation.reverse_field is not None:
+        field_name = relation.reverse_field.name
+        values_by_obj = {}
+        for obj, value in links:
+            values_by_obj.setdefault(obj, []).append(value)
+            setattr(value, field_name, obj)
+        for obj, values in values_by_obj.items():
+            manager = relation.related_model._base_manager
+            manager.filter(pk__in=[value.pk for value in values]).update(
+                **{field_name: obj})
+    else:
+        for obj, value in links:
+            getattr(obj, name).add(value)
+
+
+def get_unsaved_graph(objs):
+    """Returns the unsaved objects reachable from objs through foreign keys.
+
+    Objects are grouped in lists of objects of the same model, each list only
+    depends on objects of the lists before it.
+
+    """
+
+    depths = {}
+    found = []
+
+    def visit(obj):
+        key = id(obj)
+        if key in depths:
+            return depths[key]
+
+        depths[key] = depth = 0
+        for field in obj._meta.fields:
+            if isinstance(field, ForeignKey):
+                parent = getattr(obj, field.get_cache_name(), None)
+                if parent is not None and parent.pk is None:
+                    depth = max(depth, visit(parent) + 1)
+
+        depths[key] = depth
+        found.append(obj)
+        return depth
+
+    for obj in objs:
+        if obj.pk is None:
+            visit(obj)
+
+    groups = {}
+    for obj in found:
+        groups.setdefault((depths[id(obj)], type(obj)), []).append(obj)
+
+    return [groups[key] for key in sorted(groups, key=lambda key: key[0])]
+
+
+def update_foreign_keys(obj):
+    """Copies the primary keys of the related objects cached by obj into its
+    foreign key columns."""
+
+    for field in obj._meta.fields:
+        if isinstance(field, ForeignKey):
+            parent = getattr(obj, field.get_cache_name(), None)
+            if parent is not None:
+                setattr(obj, field.attname, parent.pk)
+
+
+def chunked(values, size):
+    """Splits values into lists of at most size elements."""
+
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+class NewRelated(object):
+    """Creates a new related object every time it is asked for one. This is
+    the default strategy of ModelFactory."""
+
+    def get(self, mockup):
+        return mockup.create()
+
+    def get_many(self, mockup, n):
+        return mockup.create_batch(n)
+
+    def reset(self):
+        pass
+
+
+class PooledRelated(object):
+    """Reuses a pool of at most size related objects per model.
+
+    The first requests fill the pool with new objects, after that objects are
+    chosen at random from it. Call reset() when the objects of the pool no
+    longer exist, e.g. after a test transaction was rolled back.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pools = {}
+
+    def get(self, mockup):
+        return self.get_many(mockup, 1)[0]
+
+    def get_many(self, mockup, n):
+        pool = self.pools.setdefault(mockup.model_class, [])
+
+        missing = min(n, self.size - len(pool))
+        if missing > 0:
+            objs = mockup.create_batch(missing)
+            pool.extend(objs)
+        else:
+            objs = []
+
+        indexes = generators.random_integers(0, len(pool) - 1, n - len(objs))
+        return objs + [pool[i] for i in indexes]
+
+    def reset(self):
+        self.pools = {}
+
+
+class ExistingRelated(object):
+    """Chooses related objects among the rows already in the database,
+    creating new ones only when the table is empty."""
 
     def __init__(self):
+        self.selectors = {}
+
+    def get(self, mockup):
+        return self.get_many(mockup, 1)[0]
+
+    def get_many(self, mockup, n):
+        try:
+            selector = self.selectors[mockup.model_class]
+        except KeyError:
+            selector = generators.InstanceSelector(mockup.model_class,
+                                                   replace=True)
+            self.selectors[mockup.model_class] = selector
+
+        objs = selector.select(n)
+        if len(objs) < n:
+            objs.extend(mockup.create_batch(n - len(objs)))
+            selector.refresh()
+        return objs
+
+    def reset(self):
+        self.selectors = {}
+
+
+class Atomic(object):
+    """Context manager running its block in a transaction of the factory.
+
+    The outermost block owns the transaction when there is none already, it
+    commits at the end or rolls everything back if an exception is raised.
+    Nested blocks, and blocks inside a transaction managed by someone else,
+    use savepoints when the backend supports them.
+
+    """
+
+    def __init__(self, using=None):
+        self.using = using or DEFAULT_DB_ALIAS
+        self.owner = False
+        self.sid = None
+
+    def __enter__(self):
+        using = self.using
+        if transaction.is_managed(using=using):
+            self.sid = transaction.savepoint(using=using)
+        else:
+            transaction.enter_transaction_management(using=using)
+            transaction.managed(True, using=using)
+            self.owner = True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        using = self.using
+        if self.owner:
+            try:
+                if exc_type is None:
+                    transaction.commit(using=using)
+                else:
+                    transaction.rollback(using=using)
+            finally:
+                transaction.leave_transaction_management(using=using)
+        elif self.sid is not None:
+            if exc_type is None:
+                transaction.savepoint_commit(self.sid, using=using)
+            else:
+                transaction.savepoint_rollback(self.sid, using=using)
+
+
+class ModelFactory(object):
+
+    def __init__(self, use_transactions=False):
+        # mockups by key and by short name, see register()
         self.mockups = {}
+        # mockups by model class
+        self.models = {}
+        self.unique_values = {}
+        self.generators = {}
+
+        # when set, every create runs in a transaction, see atomic()
+        self.use_transactions = use_transactions
+
+        # strategies used to obtain the objects of foreign keys
+        self.related_strategies = {}
+        self.default_related_strategy = NewRelated()
+
+        # (index, count) of the share of unique values and primary keys this
+        # factory may use, see set_partition()
+        self.partition = None
+        self.last_pks = {}
+
+        # instrumentation hooks, see add_hook()
+        self.hooks = []
+        self.counters = None
+        self.query_log = None
+
+        # changes every time the registry changes, invalidating the
+        # MockupPlans compiled by the registered mockups
+        self.version = 0
 
     def get_key(self, model):
         """ Returns the key of a mockup class for a given model """
         key = model
         if not isinstance(model, basestring):
-            content_type = ContentType.objects.get_for_model(model)
-            key = ".".join(content_type.natural_key())
+            # proxy models share the key of the model they proxy
+            opts = model._meta
+            while opts.proxy:
+                opts = opts.proxy_for_model._meta
+            key = "%s.%s" % (opts.app_label, opts.object_name)
 
         return key.lower()
 
@@ -78,6 +782,9 @@ class ModelFactory(object):
         share the same name. In that case, the second key will point to an array
         of mockup classes
 
+        The mockup is also stored by model class, so lookups by class don't
+        build any key.
+
         """
 
         mockup_class = mockup_class or Mockup
@@ -99,12 +806,302 @@ class ModelFactory(object):
             self.mockups[second_key] = mockup
 
         self.mockups[key] = mockup
+        self.models[model] = mockup
+        self.version += 1
+
+    def get_unique_values(self, model_class, field_names):
+        """Returns the UniqueValues tracking the given fields of a model"""
+
+        key = (model_class, tuple(field_names))
+
+        try:
+            return self.unique_values[key]
+        except KeyError:
+            fields = [model_class._meta.get_field(name) for name in field_names]
+            unique = self.unique_values[key] = UniqueValues(
+                model_class, fields, self.partition)
+            return unique
+
+    def reset_unique_values(self):
+        """Forgets the tracked unique values, they will be loaded again from
+        the database when needed. Use this when rows are inserted without
+        using this factory."""
+
+        self.unique_values = {}
+
+    def set_partition(self, partition):
+        """Restricts the unique values and primary keys used by this factory
+        to one of several disjoint partitions, given as an (index, count)
+        tuple, so factories in different processes can create objects of the
+        same models at the same time. None removes the restriction.
+
+        Objects of multi-table inherited models still obtain their primary
+        keys from the database.
+
+        """
+
+        self.partition = partition
+        self.last_pks = {}
+        self.reset_unique_values()
 
+    def get_primary_keys(self, model_class, n):
+        """Returns n unused primary keys of model_class from the partition
+        of this factory."""
+
+        index, count = self.partition
+        try:
+            last = self.last_pks[model_class]
+        except KeyError:
+            last = model_class._base_manager.aggregate(
+                last=models.Max('pk'))['last'] or 0
+
+        first = last + 1 + (index - last - 1) % count
+        pks = range(first, first + n * count, count)
+        self.last_pks[model_class] = pks[-1]
+        return pks
+
+    def assign_primary_keys(self, model_class, objs):
+        """Sets the primary keys of objs when the factory has a partition,
+        instead of leaving them to the database."""
+
+        if self.partition is None:
+            return
+        if not isinstance(model_class._meta.pk, AutoField):
+            return
+
+        objs = [obj for obj in objs if obj.pk is None]
+        if objs:
+            pks = self.get_primary_keys(model_class, len(objs))
+            for obj, pk in zip(objs, pks):
+                obj.pk = pk
+
+    def add_hook(self, hook):
+        """Adds an instrumentation hook, an object with start(span) and
+        end(span) methods called around every instrumentation.Span of the
+        creation of mockups."""
+
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def span(self, event, model, field=None, count=0, name=None):
+        """Returns a context manager reporting a step of the creation of
+        mockups to the hooks."""
+
+        if not self.hooks:
+            return NULL_SPAN
+        return Span(list(self.hooks), event, model, field, count, name)
+
+    def enable_stats(self):
+        """Starts counting objects, queries and time by model and generator,
+        see stats()."""
+
+        if self.counters is None:
+            self.counters = Counters()
+            self.query_log = enable_query_log()
+            self.add_hook(self.counters)
+
+    def disable_stats(self):
+        if self.counters is not None:
+            self.remove_hook(self.counters)
+            restore_query_log(self.query_log)
+            self.counters = self.query_log = None
+
+    def stats(self):
+        """Returns a snapshot of the counters started by enable_stats().
+
+        models maps model labels to the objects created, the queries issued
+        and the seconds spent in each step ("mockup_data", "generate",
+        "save" and "tomany") by that model, excluding the creation of other
+        models. generators maps model.field labels to the values generated
+        and the seconds it took.
+
+        """
+
+        if self.counters is None:
+            return {'models': {}, 'generators': {}}
+        return self.counters.snapshot()
+
+    def measure(self):
+        """Returns a context manager counting, with a new Counters, only
+        what happens inside its block.
+
+        >>> with factory.measure() as counters:
+        ...     factory[Entry].create(comments=50)
+        >>> counters.snapshot()
+
+        """
+
+        return Measurement(self)
+
+    def trace(self):
+        """Returns a context manager recording the tree of objects created
+        inside its block in a new instrumentation.Trace, exportable as JSON
+        and as folded stacks.
+
+        >>> with factory.trace() as trace:
+        ...     factory[Comment].create()
+        >>> open('comment.folded', 'w').write(trace.to_folded())
+
+        """
+
+        return Tracing(self)
+
+    def query_budget(self, budget):
+        """Returns a context manager failing with
+        instrumentation.QueryBudgetExceeded when more than budget queries
+        are issued inside its block.
+
+        >>> with factory.query_budget(5):
+        ...     factory['entry'].create(comments=100)
+
+        """
+
+        return QueryBudget(self, budget)
+
+    def set_related_strategy(self, model, strategy):
+        """Sets how objects of model are obtained when a foreign key to model
+        needs one. strategy is a NewRelated, PooledRelated or ExistingRelated
+        instance, or any object with the same methods."""
+
+        self.related_strategies[model] = strategy
+
+    def get_related_strategy(self, model):
+        return self.related_strategies.get(model,
+                                           self.default_related_strategy)
+
+    def get_related(self, model):
+        """Returns an object of model to be assigned to a foreign key."""
+
+        return self.get_related_strategy(model).get(self[model])
+
+    def get_related_many(self, model, n):
+        """Returns n objects of model to be assigned to foreign keys."""
+
+        return self.get_related_strategy(model).get_many(self[model], n)
+
+    def atomic(self, using=None):
+        """Returns a context manager running its block, including every
+        nested create, in a single transaction.
+
+        >>> with factory.atomic():
+        ...     factory['entry'].create(comments=50)
+
+        """
+
+        return Atomic(using)
+
+    def save_graph(self, objs):
+        """Saves objects returned by Mockup.build along with every unsaved
+        object they reference, inserting each model with bulk queries in
+        dependency order. Pending to-many relationships are created after
+        that."""
+
+        if self.use_transactions:
+            with self.atomic():
+                return self.save_graph_objects(objs)
+
+        return self.save_graph_objects(objs)
+
+    def save_graph_objects(self, objs):
+        for group in get_unsaved_graph(objs):
+            for obj in group:
+                update_foreign_keys(obj)
+            self.check_graph_unique(type(group[0]), group)
+            self.assign_primary_keys(type(group[0]), group)
+            bulk_insert(type(group[0]), group)
+
+            plan = self[type(group[0])].get_plan()
+            pending = [(obj, obj.__dict__.pop('_mockup_data')) for obj in group
+                       if '_mockup_data' in obj.__dict__]
+            pending = [(obj, model_data) for obj, model_data in pending
+                       if model_data.get_data_dict(plan.tomany_fields)]
+            if pending:
+                create_tomany(self, plan, pending)
+
+        return objs
+
+    def check_graph_unique(self, model_class, objs):
+        """Replaces generated values of unsaved objects that would break a
+        unique constraint.
+
+        Mockup.build only checks unique values against those tracked in
+        memory, here they are checked against the database too. Values that
+        were forced, or objects not built by a mockup, are left as they
+        are.
+
+        """
+
+        plan = self[model_class].get_plan()
+        opts = model_class._meta
+        groups = [([name], [opts.get_field(name)])
+                  for name in sorted(plan.unique_fields)]
+        for field_names, fields in groups + plan.unique_together:
+            unique = self.get_unique_values(fields[0].model, field_names)
+            stored = unique.seed()
+            # values taken by the objects already checked
+            taken = set()
+
+            for obj in objs:
+                get_values = lambda: tuple(getattr(obj, field.attname)
+                                           for field in fields)
+                key = unique.get_key(get_values())
+                model_data = obj.__dict__.get('_mockup_data')
+                collides = key in stored or key in taken
+
+                if collides and model_data is not None:
+                    generated = [field for field in fields
+                                 if field.name not in model_data.force and
+                                 not isinstance(field, ForeignKey)]
+                    if generated:
+                        field = generated[-1]
+                        base = getattr(obj, field.attname)
+                        while True:
+                            setattr(obj, field.attname,
+                                    unique.derive(base, field))
+                            key = unique.get_key(get_values())
+                            if key not in taken and unique.add(key, False):
+                                break
+
+                taken.add(key)
+                unique.values.add(key)
+
+    def get_generator(self, field):
+        """Returns the generator of values for field, it is created the first
+        time and reused afterwards."""
+
+        key = (field.model, field.name)
+
+        try:
+            return self.generators[key]
+        except KeyError:
+            generator = self.generators[key] = make_generator(field)
+            return generator
+
+    def set_generator(self, field, generator):
+        """Replaces the generator used for field."""
+
+        self.generators[(field.model, field.name)] = generator
+
+    def reset_generators(self, field=None):
+        """Discards the generator of field, or every generator if no field is
+        given, so new ones are created when needed."""
+
+        if field is None:
+            self.generators = {}
+        else:
+            self.generators.pop((field.model, field.name), None)
 
     def __getitem__(self, model):
         """ returns a mockup using the model parameter which can be
         a django Model or an instance of a basestring """
 
+        try:
+            return self.models[model]
+        except KeyError:
+            pass
+
         key = self.get_key(model)
 
         try:
@@ -127,10 +1124,24 @@ class ModelFactory(object):
 
 class MockupData(object):
 
-    def __init__(self, factory=None, force=None):
+    def __init__(self, factory=None, force=None, defer_related=False,
+                 plan=None, build=False):
         self.data = {}
         self.force = force or {}
         self.factory = factory
+        self.plan = plan
+
+        # when build is set, related objects are built without saving them
+        # and the database is not queried
+        self.build = build
+
+        # when defer_related is set, related objects are not created right
+        # away, instead the model is kept in self.related so the caller can
+        # create all of them at once.
+        self.defer_related = defer_related
+        self.related = {}
+        # unique_together groups waiting for deferred related objects
+        self.unchecked = []
 
         self.preset_forced()
 
@@ -160,10 +1171,18 @@ class MockupData(object):
             return
 
         if model is not None:
-            obj = self.factory[model].create()
+            if self.build:
+                self.data[name] = self.factory[model].build()
+                return
+            if self.defer_related:
+                self.related[name] = model
+                return
+            with self.factory.span('related', model, name=name):
+                obj = self.factory.get_related(model)
             self.data[name] = obj
             return
         else:
+            self.related.pop(name, None)
             self.data[name] = constant
             return
 
@@ -183,78 +1202,51 @@ class MockupData(object):
         "Obtains an instance of the model using this data set."
 
         tomany_fields, regular_fields = self.get_fields(model_class)
+        if self.factory is None and self.get_data_dict(tomany_fields):
+            raise ValueError("To-many relationships can't be created "
+                             "without a factory")
 
-        tomany_data = self.get_data_dict(tomany_fields)
-        regular_data = self.get_data_dict(regular_fields)
+        model = self.build_model(model_class)
+        if self.factory is None:
+            model.save()
+        else:
+            self.factory.assign_primary_keys(model_class, [model])
+            with self.factory.span('save', model_class, count=1):
+                model.save()
+        self.create_related(model)
 
-        model = model_class(**regular_data)
-        model.save()
+        return model
 
-        for tomany_field, values in tomany_data.items():
-            manager = getattr(model, tomany_field)
-            related_model = manager.model
+    def build_model(self, model_class):
+        "Obtains an unsaved instance of the model using this data set."
 
-            reverse_related_name = get_field_from_related_name(
-                related_model, tomany_field)
+        tomany_fields, regular_fields = self.get_fields(model_class)
 
-            if type(values) is int:
-                objs = []
-                for x in range(0, values):
-                    if reverse_related_name is None:
-                        data = {}
-                    else:
-                        data = {reverse_related_name.name: model}
-                    objs.append(self.factory[related_model].create(**data))
-                values = objs
-            if type(values) is not list:
-                values = [values]
+        return model_class(**self.get_data_dict(regular_fields))
 
-            try:
-                for value in values:
-                    force = {}
-                    for field in manager.through._meta.fields:
-                        if isinstance(field, ForeignKey):
-                            if isinstance(model, field.rel.to):
-                                force[field.name] = model
-                            elif isinstance(value, field.rel.to):
-                                force[field.name] = value
-                    self.factory[manager.through].create(**force)
-            except AttributeError:
-                for value in values:
-                    manager.add(value)
-        return model
+    def create_related(self, model):
+        """Creates the to-many relationships of an already saved model
+        using this data set."""
+
+        plan = self.get_plan(type(model))
+        if self.get_data_dict(plan.tomany_fields):
+            create_tomany(self.factory, plan, [(model, self)])
 
     def get_fields(self, model_class):
         """Obtains a list of fields of the given model class separated
         between to-many and non-to-many (regular)"""
 
-        many = []
-        regular = []
+        plan = self.get_plan(model_class)
+        return plan.tomany_fields, plan.regular_fields
 
-        class_fields = model_class._meta.get_all_field_names()
-        for field in class_fields:
-            try:
-                field_obj = model_class._meta.get_field(field)
-                is_tomany = isinstance(field_obj, ManyToManyField)
-            except Exception:
-                try:
-                    field_obj = getattr(model_class, field)
-                    is_tomany = isinstance(
-                        field_obj,
-                        ForeignRelatedObjectsDescriptor)
-                    is_tomany = is_tomany or isinstance(
-                        field_obj, ManyRelatedObjectsDescriptor)
-                except AttributeError:
-                    #probably a to-many field with no reverse relationship
-                    #defined
-                    continue
-
-            if is_tomany:
-                many.append(field)
-            else:
-                regular.append(field)
+    def get_plan(self, model_class):
+        """Returns the MockupPlan to be used for model_class."""
 
-        return many, regular
+        if self.plan is not None and self.plan.model_class is model_class:
+            return self.plan
+        if self.factory is None:
+            return MockupPlan(model_class)
+        return self.factory[model_class].get_plan()
 
 
 class Mockup(object):
@@ -262,13 +1254,36 @@ class Mockup(object):
     def __init__(self, model_class, factory):
         self.model_class = model_class
         self.factory = factory
+        self.plan = None
+
+    def get_plan(self):
+        """Returns the MockupPlan of the model, compiling it again only if
+        the registry of the factory changed since it was compiled."""
+
+        plan = self.plan
+        if plan is None or plan.version != self.factory.version:
+            plan = MockupPlan(self.model_class, self.factory.version)
+            self.plan = plan
+        return plan
 
     @staticmethod
-    def generate_value(field, model_data=None):
+    def generate_value(field, model_data=None, factory=None, seed=True):
         """Obtains a automatically generated value for a given a django model
         field
 
         """
+        if model_data is not None:
+            factory = factory or model_data.factory
+            seed = seed and not model_data.build
+
+        if factory is not None and factory.hooks:
+            with factory.span('generate', field.model, field):
+                return Mockup.generate_field_value(field, model_data, factory,
+                                                   seed)
+        return Mockup.generate_field_value(field, model_data, factory, seed)
+
+    @staticmethod
+    def generate_field_value(field, model_data, factory, seed):
         value = None
         if field.default is not NOT_PROVIDED:
             if type(field.default) in [types.FunctionType, types.LambdaType]:
@@ -276,59 +1291,271 @@ class Mockup(object):
             else:
                 value = field.default
         else:
-            field_type = type(field)
-            generator_class = FIELDCLASS_TO_GENERATOR[field_type]
-            if issubclass(generator_class, generators.FieldGenerator):
-                generator = generator_class(field)
-            elif issubclass(generator_class, generators.Generator):
-                generator = generator_class()
+            if factory is None:
+                generator = make_generator(field)
+            else:
+                generator = factory.get_generator(field)
             value = generator.get_value()
-            if field.unique:
-                while True:
-                    try:
-                        field.model.objects.get(**{field.name: value})
-                        value = generator.get_value()
-                    except:
-                        break
+            if field.unique and value is not None:
+                value = Mockup.unique_value(field, value, generator, factory,
+                                            seed)
         if value is not None:
             if model_data:
                 model_data.set(field.name, value)
             else:
                 return value
 
+    @staticmethod
+    def unique_value(field, value, generator, factory=None, seed=True):
+        """Returns value or a new value from generator if value is already
+        taken by another object. With seed set to False the database is not
+        queried."""
+
+        if factory is None:
+            manager = field.model._base_manager
+            while manager.filter(**{field.name: value}).exists():
+                value = generator.get_value()
+            return value
+
+        unique = factory.get_unique_values(field.model, [field.name])
+        return unique.unique_value(value, generator.get_value, seed)
+
     def mockup_data(self, data):
         pass
 
     def get_mockup_data(self, **kwargs):
 
-        force = kwargs
+        model_data = MockupData(force=kwargs, factory=self.factory,
+                                plan=self.get_plan())
+
+        with self.factory.span('mockup_data', self.model_class):
+            return self.fill_mockup_data(model_data)
+
+    def fill_mockup_data(self, model_data):
+        """Populates model_data with the values required to create an object
+        of self.model_class."""
 
-        model_class = self.model_class
-        model_data = MockupData(force=force, factory=self.factory)
+        plan = self.get_plan()
 
         self.mockup_data(model_data)
 
-        fields = model_class._meta.fields
-        for field in fields:
+        for field, related_model, generator_class in plan.fields:
 
             if field.name in model_data.data:
+                if field.name in plan.unique_fields:
+                    # keep generated values from colliding with this one
+                    unique = self.factory.get_unique_values(
+                        field.model, [field.name])
+                    unique.add((model_data[field.name],),
+                               not model_data.build)
                 continue
 
-            if isinstance(field, ForeignKey):
-                related_model = field.rel.to
+            if related_model is not None:
                 model_data.set(field.name, model=related_model)
+            elif generator_class is None and field.default is NOT_PROVIDED:
+                if type(field) is not AutoField:
+                    msg = "Could not mockup data for %s.%s %s"
+                    msg %= (self.model_class.__name__, field.name, type(field))
+                    raise Exception(msg)
             else:
-                try:
-                    Mockup.generate_value(field, model_data)
-                except KeyError, e:
-                    if e.args[0] != models.fields.AutoField:
-                        msg = "Could not mockup data for %s.%s %s"
-                        msg %= (model_class.__name__, field.name, e.args[0])
-                        raise Exception(msg)
+                Mockup.generate_value(field, model_data)
+
+        self.check_unique_together(model_data)
 
         return model_data
 
+    def check_unique_together(self, model_data, groups=None):
+        """Replaces generated values that would break a unique_together
+        constraint of the model.
+
+        Groups including deferred related objects are kept in
+        model_data.unchecked to be checked once those objects exist.
+
+        """
+
+        for field_names, fields in groups or self.get_plan().unique_together:
+            missing = [name for name in field_names
+                       if name not in model_data.data]
+            if missing:
+                if all(name in model_data.related for name in missing):
+                    model_data.unchecked.append((field_names, fields))
+                continue
+
+            generated = [field for field in fields
+                         if field.name not in model_data.force and
+                         not isinstance(field, ForeignKey)]
+            unique = self.factory.get_unique_values(
+                fields[0].model, field_names)
+
+            attempts = 0
+            values = [model_data[name] for name in field_names]
+            if any(isinstance(value, models.Model) and value.pk is None
+                   for value in values):
+                # unsaved related objects are always new
+                continue
+
+            seed = not model_data.build
+            base = None
+            while True:
+                values = tuple(model_data[name] for name in field_names)
+                if base is None:
+                    if unique.claim(values, seed):
+                        break
+                elif unique.add(values, seed):
+                    # derived values are always in the partition
+                    break
+
+                if not generated:
+                    # only forced values, let the database complain
+                    break
+
+                attempts += 1
+                if attempts < unique.max_attempts:
+                    for field in generated:
+                        model_data[field.name] = Mockup.generate_value(
+                            field, factory=self.factory, seed=seed)
+                else:
+                    field = generated[-1]
+                    if base is None:
+                        base = model_data[field.name]
+                    model_data[field.name] = unique.derive(base, field)
+
     def create(self, **kwargs):
         """Creates a mockup object."""
 
+        if self.factory.use_transactions:
+            with self.factory.atomic(router.db_for_write(self.model_class)):
+                return self.get_mockup_data(**kwargs).create_model(
+                    self.model_class)
+
         return self.get_mockup_data(**kwargs).create_model(self.model_class)
+
+    def build(self, **kwargs):
+        """Returns an unsaved mockup object without querying the database.
+
+        Objects required by foreign keys are built too and linked in memory.
+        To-many relationships are kept and created when the object is saved
+        with ModelFactory.save_graph.
+
+        """
+
+        model_data = MockupData(force=kwargs, factory=self.factory,
+                                plan=self.get_plan(), build=True)
+        self.fill_mockup_data(model_data)
+
+        obj = model_data.build_model(self.model_class)
+        # used by ModelFactory.save_graph
+        obj._mockup_data = model_data
+        return obj
+
+    def build_batch(self, n, **kwargs):
+        """Returns a list of n unsaved mockup objects."""
+
+        return [self.build(**kwargs) for x in xrange(n)]
+
+    def create_batch(self, n, **kwargs):
+        """Creates n mockup objects inserting them with bulk queries.
+
+        Related objects required by foreign keys are also created in batches.
+        Returns the list of created objects.
+
+        """
+
+        return self.create_many([kwargs] * n)
+
+    def create_iter(self, n, chunk_size=BATCH_SIZE, pks=False, **kwargs):
+        """Creates n mockup objects chunk by chunk, yielding them as they
+        are created, or only their primary keys if pks is set.
+
+        Only one chunk of objects is kept in memory at a time. With
+        use_transactions set, each chunk is created in its own transaction.
+        Raises ValueError if chunk_size is less than 1.
+
+        """
+
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        return self.iter_chunks(n, chunk_size, pks, kwargs)
+
+    def iter_chunks(self, n, chunk_size, pks, kwargs):
+        while n > 0:
+            count = min(n, chunk_size)
+            objs = self.create_many([kwargs] * count)
+            if pks:
+                objs = [obj.pk for obj in objs]
+
+            for obj in objs:
+                yield obj
+
+            del objs
+            n -= count
+
+    def create_many(self, forces):
+        """Creates one mockup object for each dict of forced values in
+        forces, inserting them with bulk queries."""
+
+        if self.factory.use_transactions:
+            with self.factory.atomic(router.db_for_write(self.model_class)):
+                return self.create_many_objects(forces)
+
+        return self.create_many_objects(forces)
+
+    def create_many_objects(self, forces):
+        plan = self.get_plan()
+        span = self.factory.span
+        datas = []
+        with span('mockup_data', self.model_class):
+            for force in forces:
+                model_data = MockupData(force=force, factory=self.factory,
+                                        defer_related=True, plan=plan)
+                datas.append(self.fill_mockup_data(model_data))
+
+            self.create_deferred_related(datas)
+
+        objs = [model_data.build_model(self.model_class)
+                for model_data in datas]
+        self.factory.assign_primary_keys(self.model_class, objs)
+        with span('save', self.model_class, count=len(objs)):
+            bulk_insert(self.model_class, objs)
+
+        if plan.tomany_fields:
+            create_tomany(self.factory, plan, zip(objs, datas))
+
+        return objs
+
+    def insert(self, n, chunk_size=None, **kwargs):
+        """Inserts n mockup rows with raw queries, without creating model
+        instances. See inserts.InsertEngine."""
+
+        from inserts import InsertEngine
+
+        engine = InsertEngine(self.factory, self.model_class,
+                              chunk_size=chunk_size)
+        if self.factory.use_transactions:
+            with self.factory.atomic(engine.using):
+                return engine.insert(n, **kwargs)
+
+        return engine.insert(n, **kwargs)
+
+    def create_deferred_related(self, datas):
+        """Creates the related objects deferred by the given data sets, one
+        batch per field."""
+
+        pending = {}
+        for model_data in datas:
+            for name, related_model in model_data.related.items():
+                pending.setdefault((name, related_model), []).append(
+                    model_data)
+
+        for (name, related_model), field_datas in pending.items():
+            with self.factory.span('related', related_model, name=name):
+                objs = self.factory.get_related_many(related_model,
+                                                     len(field_datas))
+            for model_data, obj in zip(field_datas, objs):
+                model_data[name] = obj
+                del model_data.related[name]
+
+        for model_data in datas:
+            if model_data.unchecked:
+                groups, model_data.unchecked = model_data.unchecked, []
+                self.check_unique_together(model_data, groups)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import random
+
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import get_models
+
+import generators
+from models import BATCH_SIZE
+
+# factory used by the worker processes, set by init_worker
+worker_factory = None
+
+
+def init_worker(factory):
+    """Prepares a forked worker process. Connections inherited from the
+    parent are dropped without closing them, so the worker opens its own."""
+
+    global worker_factory
+    worker_factory = factory
+    for connection in connections.all():
+        connection.connection = None
+
+
+def run_worker(factory, model, index, count, n, seed, chunk_size, force):
+    """Creates n objects of model using partition index out of count.
+    Returns the number of created objects."""
+
+    generators.seed(seed)
+    factory.set_partition((index, count))
+    try:
+        created = 0
+        for pk in factory[model].create_iter(n, chunk_size, pks=True,
+                                             **force):
+            created += 1
+        return created
+    finally:
+        factory.set_partition(None)
+
+
+def run_task(task):
+    return run_worker(worker_factory, *task)
+
+
+def reset_sequences(models, using=None):
+    """Moves the sequences of the primary keys of models past the keys
+    assigned explicitly by the workers."""
+
+    for model in models:
+        db = using or router.db_for_write(model)
+        connection = connections[db]
+        statements = connection.ops.sequence_reset_sql(no_style(), [model])
+        if statements:
+            cursor = connection.cursor()
+            for sql in statements:
+                cursor.execute(sql)
+            transaction.commit_unless_managed(using=db)
+
+
+def populate(factory, model, n, processes=None, seed=None,
+             chunk_size=BATCH_SIZE, **kwargs):
+    """Creates n mockup objects of model splitting them across a pool of
+    worker processes.
+
+    Every worker has its own stream of random values, derived from seed, and
+    a partition of the unique values and primary keys so workers never
+    collide. Each worker writes through its own connection with batched
+    inserts. Forced values are given as kwargs, as in Mockup.create.
+    Returns the number of created objects.
+
+    Workers are forked, so the database must be reachable from several
+    processes: in-memory sqlite databases are not.
+
+    >>> populate(factory, Entry, 1000000, processes=32, seed=1)
+
+    """
+
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+
+    processes = processes or multiprocessing.cpu_count()
+    processes = max(1, min(processes, n))
+
+    seeds = random.Random(seed)
+    tasks = []
+    for index in xrange(processes):
+        share = n // processes + (index < n % processes)
+        tasks.append((model, index, processes, share,
+                      seeds.getrandbits(64), chunk_size, kwargs))
+
+    if processes == 1:
+        created = [run_worker(factory, *task) for task in tasks]
+    else:
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(processes, init_worker, (factory,))
+        try:
+            created = pool.map(run_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    reset_sequences(get_models(include_auto_created=True))
+    factory.reset_unique_values()
+
+    return sum(created)
@@ -85,7 +85,8 @@ class TastyMockup(object):
                         value = kwargs[field_name]
                     elif isinstance(attribute, basestring):
                         model_field = self.model_class._meta.get_field(attribute)
-                        value = unicode(Mockup.generate_value(model_field))
+                        value = unicode(Mockup.generate_value(
+                            model_field, factory=self.factory.model_factory))
                     else:
                         if issubclass(generator_class, generators.FieldGenerator):
                             generator = generator_class(field)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import cPickle as pickle
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+from django.db.models import get_models
+
+import generators
+from models import Mockup
+from parallel import reset_sequences
+from specs import sort_models
+
+# changes whenever the format of the snapshot files changes
+FORMAT_VERSION = 1
+
+
+def get_source(obj):
+    """Returns the source code of obj, or its name when the source is not
+    available."""
+
+    try:
+        return inspect.getsource(obj)
+    except (IOError, TypeError):
+        return '%s.%s' % (getattr(obj, '__module__', ''),
+                          getattr(obj, '__name__', repr(obj)))
+
+
+class Snapshot(object):
+    """Cached copy of the rows created by a build function.
+
+    The rows of the given models, or of every model, are stored in a file
+    named after a hash of the schema of those models, the source of build
+    and of the mockups registered in factory and their bases, the spec and
+    the seed. Any change to them produces a new hash, so stale snapshots are
+    never restored.
+
+    Restoring a snapshot replaces the rows of those tables with the stored
+    ones. Snapshots are kept in directory, or in
+    settings.CHOCOLATE_SNAPSHOT_DIR. Without either, build is always run.
+
+    >>> Snapshot('blog', build, factory, seed=1).restore_or_build()
+
+    """
+
+    def __init__(self, name, build, factory=None, spec=None, seed=None,
+                 models=None, directory=None, using=None):
+        self.name = name
+        self.build = build
+        self.factory = factory
+        self.spec = spec
+        self.seed = seed
+        self.using = using
+
+        if models is None:
+            models = get_models(include_auto_created=True)
+        else:
+            models = list(models) + [
+                field.rel.through for model in models
+                for field in model._meta.many_to_many
+                if field.rel.through._meta.auto_created]
+
+        tables = set()
+        self.models = []
+        for model in sort_models(models):
+            opts = model._meta
+            if opts.proxy or not opts.managed or opts.db_table in tables:
+                continue
+            tables.add(opts.db_table)
+            self.models.append(model)
+
+        if directory is None:
+            directory = getattr(settings, 'CHOCOLATE_SNAPSHOT_DIR', None)
+        self.directory = directory
+
+    def get_using(self, model):
+        return self.using or router.db_for_write(model)
+
+    def get_key(self):
+        """Returns the hash identifying the contents of the snapshot."""
+
+        key = hashlib.sha1()
+        key.update('%d\n' % FORMAT_VERSION)
+
+        for model in self.models:
+            connection = connections[self.get_using(model)]
+            opts = model._meta
+            key.update('%s.%s %s\n' % (opts.app_label, opts.object_name,
+                                       opts.db_table))
+            for field in opts.local_fields:
+                key.update('%s %s %s %s %s %s\n' % (
+                    field.name, field.column, type(field).__name__,
+                    field.db_type(connection=connection), field.null,
+                    field.unique))
+
+        if self.factory is not None:
+            mockup_classes = set()
+            for mockup in self.factory.models.values():
+                # the bases of a mockup change what it creates too
+                for mockup_class in inspect.getmro(type(mockup)):
+                    mockup_classes.add(mockup_class)
+                    if mockup_class is Mockup:
+                        break
+            for source in sorted(get_source(mockup_class)
+                                 for mockup_class in mockup_classes):
+                key.update(source)
+
+        key.update(get_source(self.build))
+        key.update(json.dumps(self.spec, sort_keys=True, default=repr))
+        key.update(repr(self.seed))
+        return key.hexdigest()
+
+    def get_path(self):
+        return os.path.join(self.directory,
+                            '%s-%s.pickle' % (self.name, self.get_key()))
+
+    def get_columns(self, model):
+        return [field.column for field in model._meta.local_fields]
+
+    def dump(self):
+        """Returns the rows of every table of the snapshot."""
+
+        tables = []
+        for model in self.models:
+            connection = connections[self.get_using(model)]
+            quote_name = connection.ops.quote_name
+            columns = self.get_columns(model)
+
+            cursor = connection.cursor()
+            cursor.execute('SELECT %s FROM %s' % (
+                ', '.join(quote_name(column) for column in columns),
+                quote_name(model._meta.db_table)))
+            tables.append((model._meta.db_table, columns,
+                           [tuple(row) for row in cursor.fetchall()]))
+        return tables
+
+    def load(self, tables):
+        """Replaces the rows of the tables of the snapshot with the given
+        ones."""
+
+        rows = dict((table, table_rows) for table, columns, table_rows
+                    in tables)
+
+        for model in reversed(self.models):
+            using = self.get_using(model)
+            quote_name = connections[using].ops.quote_name
+            connections[using].cursor().execute(
+                'DELETE FROM %s' % quote_name(model._meta.db_table))
+
+        for model in self.models:
+            table_rows = rows.get(model._meta.db_table)
+            if not table_rows:
+                continue
+            using = self.get_using(model)
+            quote_name = connections[using].ops.quote_name
+            columns = self.get_columns(model)
+            connections[using].cursor().executemany(
+                'INSERT INTO %s (%s) VALUES (%s)' % (
+                    quote_name(model._meta.db_table),
+                    ', '.join(quote_name(column) for column in columns),
+                    ', '.join(['%s'] * len(columns))),
+                table_rows)
+
+        reset_sequences(self.models, self.using)
+        for using in set(self.get_using(model) for model in self.models):
+            transaction.commit_unless_managed(using=using)
+
+        # cached content types may point to replaced rows
+        ContentType.objects.clear_cache()
+
+    def exists(self):
+        return bool(self.directory) and os.path.exists(self.get_path())
+
+    def save(self):
+        """Stores the current rows of the tables of the snapshot."""
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        handle, path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, 'wb') as snapshot_file:
+            pickle.dump(self.dump(), snapshot_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(path, self.get_path())
+
+    def restore(self):
+        with open(self.get_path(), 'rb') as snapshot_file:
+            self.load(pickle.load(snapshot_file))
+
+        if self.factory is not None:
+            # cached values and objects may no longer exist
+            self.factory.reset_unique_values()
+            strategies = self.factory.related_strategies.values()
+            for strategy in strategies + [
+                    self.factory.default_related_strategy]:
+                strategy.reset()
+
+    def restore_or_build(self):
+        """Restores the snapshot if it exists. Otherwise runs build, seeding
+        the generators first, and stores the result. Returns True if the
+        snapshot was restored."""
+
+        if self.exists():
+            self.restore()
+            return True
+
+        if self.seed is not None:
+            generators.seed(self.seed)
+        self.build()
+
+        if self.directory:
+            self.save()
+        return False
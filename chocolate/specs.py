@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Declarative dataset specs.
+
+A spec describes how many objects of each model are created, and how many
+objects their to-many relationships get, with a dict such as:
+
+    {
+        "seed": 1,
+        "models": {
+            "blog.Entry": {
+                "count": 1000000,
+                "force": {"content": "Lorem"},
+                "tomany": {
+                    "comments": {"poisson": 5},
+                    "smart_tags": {"uniform": [0, 3]}
+                },
+                "related": {"auth.User": {"pool": 10000}}
+            }
+        }
+    }
+
+Counts and pool sizes are multiplied by the scale given to Dataset. Models are
+created after the models their foreign keys point to. "related" sets the
+strategy used for foreign keys to a model: {"pool": size} draws objects from a
+pool of that size, created when needed, and "existing" uses the objects
+already stored, such as the ones created earlier by the same spec.
+
+A "factory" entry may give the dotted path of a ModelFactory with custom
+mockups registered, and a model may give the dotted path of its Mockup class
+in "mockup".
+
+"""
+
+import json
+import math
+import time
+
+from django.db.models import get_model
+from django.db.models.fields.related import ForeignKey
+from django.utils.importlib import import_module
+
+import generators
+from models import BATCH_SIZE, ModelFactory, PooledRelated, ExistingRelated
+
+
+class SpecError(Exception):
+    pass
+
+
+class Constant(object):
+
+    def __init__(self, value):
+        self.value = int(value)
+
+    def sample(self, n):
+        return [self.value] * n
+
+
+class Uniform(object):
+    """Integers between low and high, both included."""
+
+    def __init__(self, low, high):
+        self.low = int(low)
+        self.high = int(high)
+
+    def sample(self, n):
+        return generators.random_integers(self.low, self.high, n)
+
+
+class Poisson(object):
+
+    def __init__(self, lam):
+        self.lam = float(lam)
+
+    def sample(self, n):
+        if generators.numpy is not None:
+            return generators.numpy.random.poisson(self.lam, n).tolist()
+
+        # Knuth's method, fine for the small means of to-many counts
+        limit = math.exp(-self.lam)
+        rand = generators.random.random
+        values = []
+        for i in xrange(n):
+            k = 0
+            p = rand()
+            while p > limit:
+                k += 1
+                p *= rand()
+            values.append(k)
+        return values
+
+
+DISTRIBUTIONS = {
+    'uniform': Uniform,
+    'poisson': Poisson,
+}
+
+
+def get_distribution(spec):
+    """Returns the distribution described by spec: a number, or a dict with
+    a single key naming the distribution."""
+
+    if isinstance(spec, (int, long, float)):
+        return Constant(spec)
+
+    try:
+        (name, arguments), = spec.items()
+        distribution_class = DISTRIBUTIONS[name]
+    except (AttributeError, ValueError, KeyError):
+        raise SpecError("Unknown distribution %r" % (spec,))
+
+    if not isinstance(arguments, (list, tuple)):
+        arguments = [arguments]
+    return distribution_class(*arguments)
+
+
+def get_model_class(label):
+    try:
+        app_label, model_name = label.split('.')
+    except ValueError:
+        raise SpecError("Models are given as app_label.ModelName: %r" % label)
+
+    model_class = get_model(app_label, model_name)
+    if model_class is None:
+        raise SpecError("Unknown model %r" % label)
+    return model_class
+
+
+def import_object(path):
+    module_name, name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), name)
+
+
+def load_spec(path):
+    """Reads a spec from a JSON file, or from the SPEC variable of a python
+    file."""
+
+    if path.endswith('.py'):
+        namespace = {}
+        execfile(path, namespace)
+        return namespace['SPEC']
+
+    with open(path) as spec_file:
+        return json.load(spec_file)
+
+
+def sort_models(model_classes):
+    """Returns model_classes ordered so every model comes after the models
+    its foreign keys point to. Cycles are broken arbitrarily."""
+
+    pending = list(model_classes)
+    ordered = []
+    while pending:
+        for model_class in pending:
+            parents = [field.rel.to for field in model_class._meta.fields
+                       if isinstance(field, ForeignKey)]
+            if not any(parent in pending and parent is not model_class
+                       for parent in parents):
+                break
+        else:
+            model_class = pending[0]
+
+        pending.remove(model_class)
+        ordered.append(model_class)
+    return ordered
+
+
+class ModelSpec(object):
+
+    def __init__(self, model_class, spec, scale=1):
+        self.model_class = model_class
+        self.count = int(spec.get('count', 0) * scale)
+        self.force = spec.get('force', {})
+        self.mockup_class = spec.get('mockup')
+        self.tomany = dict((name, get_distribution(value))
+                           for name, value in spec.get('tomany', {}).items())
+
+    def get_forces(self, n):
+        """Returns n dicts of forced values, with to-many counts sampled
+        from their distributions."""
+
+        forces = [dict(self.force) for i in xrange(n)]
+        for name, distribution in self.tomany.items():
+            for force, count in zip(forces, distribution.sample(n)):
+                force[name] = count
+        return forces
+
+
+class Dataset(object):
+    """Creates the objects described by a spec with batched inserts.
+
+    report, if given, is called after every chunk with the model class, the
+    number of objects created so far, the number of objects to create and
+    the seconds elapsed.
+
+    """
+
+    chunk_size = BATCH_SIZE
+
+    def __init__(self, spec, scale=1, factory=None, report=None):
+        self.scale = scale
+        self.report = report
+        self.seed = spec.get('seed')
+
+        if factory is None:
+            factory = spec.get('factory')
+            factory = import_object(factory) if factory else ModelFactory()
+        self.factory = factory
+
+        self.models = []
+        for label, model_spec in spec.get('models', {}).items():
+            self.models.append(
+                ModelSpec(get_model_class(label), model_spec, scale))
+
+        self.strategies = {}
+        for label, related in spec.get('related', {}).items():
+            self.strategies[get_model_class(label)] = related
+        for model_spec in spec.get('models', {}).values():
+            for label, related in model_spec.get('related', {}).items():
+                self.strategies[get_model_class(label)] = related
+
+    def get_strategy(self, spec):
+        if spec == 'existing':
+            return ExistingRelated()
+        try:
+            return PooledRelated(max(1, int(spec['pool'] * self.scale)))
+        except (TypeError, KeyError):
+            raise SpecError("Unknown related strategy %r" % (spec,))
+
+    def prepare(self):
+        if self.seed is not None:
+            generators.seed(self.seed)
+
+        for model_spec in self.models:
+            if model_spec.mockup_class:
+                self.factory.register(model_spec.model_class,
+                                      import_object(model_spec.mockup_class))
+
+        for model_class, spec in self.strategies.items():
+            self.factory.set_related_strategy(model_class,
+                                              self.get_strategy(spec))
+
+    def run(self):
+        """Creates every object of the spec. Returns a dict with the number
+        of objects created of each model."""
+
+        self.prepare()
+
+        by_model = dict((spec.model_class, spec) for spec in self.models)
+        created = {}
+        for model_class in sort_models(by_model.keys()):
+            created[model_class] = self.create(by_model[model_class])
+        return created
+
+    def create(self, model_spec):
+        if self.chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+
+        mockup = self.factory[model_spec.model_class]
+        start = time.time()
+        created = 0
+        while created < model_spec.count:
+            n = min(self.chunk_size, model_spec.count - created)
+            mockup.create_many(model_spec.get_forces(n))
+            created += n
+            if self.report is not None:
+                self.report(model_spec.model_class, created,
+                            model_spec.count, time.time() - start)
+        return created
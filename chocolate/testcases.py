@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import copy
+
+from django.db import connections, router, transaction
+from django.db.models import AutoField, Max, Model, get_models
+
+from models import ModelFactory, chunked, get_batch_size
+from specs import sort_models
+
+
+class MockupTestMixin(object):
+    """Mixin for django TestCase classes whose tests share mockups.
+
+    create_mockups is called once per class, before its tests, and the
+    objects it creates are committed. Each test runs inside the transaction
+    that TestCase rolls back afterwards, so changes made by a test don't
+    reach the next one. Once the tests of the class finish, every row added
+    since setUpClass is deleted.
+
+    class EntryTests(MockupTestMixin, TestCase):
+
+        @classmethod
+        def create_mockups(cls):
+            cls.entry = cls.modelfactory[Entry].create(comments=100)
+
+    The attributes set by create_mockups are copied to every test in setUp,
+    with model instances loaded again from the database, so changes a test
+    makes to the objects themselves don't reach the next one either.
+    Subclasses overriding setUp must call the setUp of this class.
+
+    Rows are found by their automatic primary keys, rows of models with
+    other primary keys are left in the database.
+
+    """
+
+    @classmethod
+    def make_factory(cls):
+        """Returns the factory used to create the mockups, available as
+        cls.modelfactory."""
+
+        return ModelFactory()
+
+    @classmethod
+    def create_mockups(cls):
+        """Creates the objects shared by the tests of the class."""
+
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        super(MockupTestMixin, cls).setUpClass()
+
+        cls.modelfactory = cls.make_factory()
+        cls.mockup_marks = get_marks()
+        names = set(cls.__dict__)
+        try:
+            cls.create_mockups()
+        except:
+            remove_rows(cls.mockup_marks)
+            raise
+        cls.mockup_attributes = [name for name in cls.__dict__
+                                 if name not in names]
+
+    def setUp(self):
+        super(MockupTestMixin, self).setUp()
+
+        for name in self.mockup_attributes:
+            setattr(self, name, reload_mockups(getattr(type(self), name)))
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_rows(cls.mockup_marks)
+        super(MockupTestMixin, cls).tearDownClass()
+
+
+def reload_mockups(value):
+    """Returns a copy of value with the model instances it contains, alone
+    or in lists, tuples and dicts, loaded again from the database."""
+
+    if isinstance(value, Model):
+        if value.pk is None:
+            return copy.deepcopy(value)
+        manager = type(value)._base_manager.db_manager(value._state.db)
+        return manager.get(pk=value.pk)
+
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, Model) and item.pk is not None
+                         for item in value):
+            kinds = set((type(item), item._state.db) for item in value)
+            if len(kinds) == 1:
+                # objects of a single model are loaded with few queries
+                model, using = kinds.pop()
+                return type(value)(reload_objects(model, using, value))
+        return type(value)(reload_mockups(item) for item in value)
+
+    if isinstance(value, dict):
+        return dict((key, reload_mockups(item))
+                    for key, item in value.items())
+
+    return copy.deepcopy(value)
+
+
+def reload_objects(model, using, objs):
+    manager = model._base_manager.db_manager(using)
+    batch_size = get_batch_size(connections[manager.db], [None])
+    loaded = {}
+    for chunk in chunked([obj.pk for obj in objs], batch_size):
+        loaded.update(manager.in_bulk(chunk))
+    return [loaded[obj.pk] for obj in objs]
+
+
+def get_marks():
+    """Returns the highest primary key of every model with automatic primary
+    keys, or inheriting them."""
+
+    marks = {}
+    for model in get_models(include_auto_created=True):
+        opts = model._meta
+        if opts.proxy or not opts.managed:
+            continue
+        # children of multi-table inheritance share the keys of the parent
+        if isinstance(opts.pk, AutoField) or opts.parents:
+            marks[model] = model._base_manager.aggregate(
+                last=Max('pk'))['last'] or 0
+    return marks
+
+
+def remove_rows(marks):
+    """Deletes the rows added after get_marks returned marks."""
+
+    databases = set()
+    for model in reversed(sort_models(marks.keys())):
+        using = router.db_for_write(model)
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+        connection.cursor().execute('DELETE FROM %s WHERE %s > %%s' % (
+            quote_name(model._meta.db_table),
+            quote_name(model._meta.pk.column)), [marks[model]])
+        databases.add(using)
+
+    for using in databases:
+        transaction.commit_unless_managed(using=using)
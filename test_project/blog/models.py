@@ -20,6 +20,9 @@ class SmartTag(models.Model):
     entry = models.ForeignKey(Entry, related_name='smart_tags')
     name = models.CharField(max_length=32)
 
+    class Meta:
+        unique_together = ('entry', 'name')
+
 
 class Actor(models.Model):
     name = models.CharField(max_length=32)
@@ -1,15 +1,36 @@
 # -*- coding: utf-8 -*-
 """ tests for the blog app """
+import datetime
+import os
+import re
+import shutil
+import tempfile
+from decimal import Decimal
+
 from api import api
 
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection, models
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 
 from mock import patch
 
-from chocolate.models import ModelFactory, Mockup
+from chocolate.models import ModelFactory, Mockup, MockupData, UniqueValues
+from chocolate.models import bulk_insert, make_generator
+from chocolate.models import PooledRelated, ExistingRelated
 from chocolate.models import UnregisteredModel, MultipleMockupsReturned
-from chocolate.generators import CharFieldGenerator
+from chocolate import generators
+from chocolate.instrumentation import QueryBudgetExceeded
+from chocolate.inserts import InsertEngine, copy_data
+from chocolate.benchmarks import check_budgets, percentile, run_benchmarks
+from chocolate.parallel import populate
+from chocolate.snapshots import Snapshot
+from chocolate.testcases import MockupTestMixin, get_marks, remove_rows
+from chocolate.specs import Dataset, SpecError, get_distribution, sort_models
+from chocolate.generators import CharFieldGenerator, StaticGenerator
 from chocolate.rest import TastyFactory
 
 from blog.models import Entry, Comment, SmartTag, Movie, Actor
@@ -21,6 +42,17 @@ from zombie_blog.models import GutturalComment
 
 class BaseTestCase(TestCase):
 
+    def captureQueries(self, func):
+        "Returns the queries executed by func"
+
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            func()
+            return connection.queries[start:]
+        finally:
+            connection.use_debug_cursor = False
+
     def assertInstanceOf(self, class_obj, instance):
         self.assertTrue(isinstance(instance, class_obj))
 
@@ -89,6 +121,16 @@ class CustomMockupTestCase(BaseTestCase):
         comment = self.modelfactory['comment'].create(first_name="Felipe")
         self.assertIsNone(comment.rating)
 
+    def test_insert_custom_mockup(self):
+        "Custom mockup_data is used for every row"
+
+        self.modelfactory[User].insert(3)
+        self.assertEqual(3, User.objects.filter(first_name="Juan").count())
+
+        self.modelfactory[Comment].insert(2, first_name="Felipe")
+        self.assertEqual(2, Comment.objects.filter(
+            author__first_name="Felipe").count())
+
 
 class MockupTests(ChocolateTestCase):
 
@@ -138,6 +180,39 @@ class MockupForceTests(ChocolateTestCase):
 
         self.assertEqual(set(entry.comments.all()), set(comments))
 
+    def test_related_quantity_queries(self):
+        """The number of queries doesn't depend on the number of related
+        objects"""
+
+        self.modelfactory["blog.entry"].create(comments=1, smart_tags=1)
+        queries = len(self.captureQueries(lambda: self.modelfactory[
+            "blog.entry"].create(comments=1, smart_tags=1)))
+
+        with self.assertNumQueries(queries):
+            entry = self.modelfactory["blog.entry"].create(comments=50,
+                                                           smart_tags=50)
+        self.assertEqual(50, entry.comments.count())
+        self.assertEqual(50, entry.smart_tags.count())
+
+    def test_m2m_quantity_queries(self):
+        "m2m relationships are created with a constant number of queries"
+
+        self.modelfactory['movie'].create(actors=1)
+        queries = len(self.captureQueries(
+            lambda: self.modelfactory['movie'].create(actors=1)))
+
+        with self.assertNumQueries(queries):
+            movie = self.modelfactory['movie'].create(actors=50)
+        self.assertEqual(50, movie.actors.count())
+
+    def test_related_explicit_m2m(self):
+        "m2m relationships can be created expliciting the related objs"
+
+        actors = self.modelfactory['actor'].create_batch(3)
+        movie = self.modelfactory['movie'].create(actors=actors)
+
+        self.assertEqual(set(actors), set(movie.actors.all()))
+
     def test_m2m_quantity_1(self):
         "It handles m2m relationships correctly"
 
@@ -163,6 +238,553 @@ class MockupForceTests(ChocolateTestCase):
             self.assertEqual(1, len(movie.actors.all()))
 
 
+class MockupBatchTests(ChocolateTestCase):
+
+    def test_create_batch(self):
+        "It creates several objects at once, with their primary keys"
+
+        entries = self.modelfactory["entry"].create_batch(5)
+
+        self.assertEqual(5, len(entries))
+        self.assertEqual(5, Entry.objects.count())
+        self.assertEqual(set(e.pk for e in entries),
+                         set(Entry.objects.values_list('pk', flat=True)))
+
+    def test_create_batch_related(self):
+        "It creates the related objects of the batch"
+
+        comments = self.modelfactory["comment"].create_batch(3)
+
+        self.assertEqual(3, Entry.objects.count())
+        self.assertEqual(6, User.objects.count())
+        for comment in comments:
+            self.assertEqual(comment, Comment.objects.get(pk=comment.pk))
+            self.assertInstanceOf(Entry, Comment.objects.get(
+                pk=comment.pk).post)
+
+    def test_create_batch_force(self):
+        "Forced values and to-many relationships are honoured"
+
+        entries = self.modelfactory["entry"].create_batch(
+            2, content="Homer Simpson", comments=2)
+
+        for entry in entries:
+            self.assertEqual("Homer Simpson", entry.content)
+            self.assertEqual(2, entry.comments.count())
+
+    def test_create_iter(self):
+        "It creates objects one chunk at a time"
+
+        count = Entry.objects.count()
+        entries = self.modelfactory[Entry].create_iter(5, chunk_size=2,
+                                                       content="Marge")
+
+        self.assertEqual(count, Entry.objects.count())
+        self.assertEqual("Marge", next(entries).content)
+        self.assertEqual(count + 2, Entry.objects.count())
+        self.assertEqual(4, len(list(entries)))
+        self.assertEqual(count + 5, Entry.objects.count())
+
+    def test_create_iter_pks(self):
+        "Only primary keys can be yielded"
+
+        pks = list(self.modelfactory[Entry].create_iter(3, chunk_size=2,
+                                                        pks=True))
+
+        self.assertEqual(3, Entry.objects.filter(pk__in=pks).count())
+
+    def test_create_iter_chunk_size(self):
+        "Chunks must hold at least one object"
+
+        mockup = self.modelfactory[Entry]
+        self.assertRaises(ValueError, mockup.create_iter, 5, chunk_size=0)
+        self.assertRaises(ValueError, mockup.insert, 5, chunk_size=-1)
+
+    def test_bulk_insert_concurrent_rows(self):
+        "It fails instead of taking the keys of rows inserted by others"
+
+        original = QuerySet.bulk_create
+
+        def bulk_create(queryset, objs):
+            original(queryset, objs)
+            Actor.objects.create(name="Lisa")
+
+        actors = [Actor(name="Bart"), Actor(name="Maggie")]
+        with patch.object(QuerySet, 'bulk_create', bulk_create):
+            self.assertRaises(generators.GeneratorException,
+                              bulk_insert, Actor, actors)
+        self.assertEqual([None, None], [actor.pk for actor in actors])
+
+    def test_create_batch_inheritance(self):
+        "It falls back to regular saves for inherited models"
+
+        self.modelfactory.register(GutturalComment)
+        self.modelfactory[GutturalComment].create_batch(2)
+
+        self.assertEqual(2, GutturalComment.objects.count())
+
+
+class InsertEngineTests(ChocolateTestCase):
+
+    def test_insert(self):
+        "It inserts rows with a query per chunk"
+
+        count = Entry.objects.count()
+        users = User.objects.count()
+        engine = InsertEngine(self.modelfactory, Entry, chunk_size=4)
+
+        queries = self.captureQueries(lambda: engine.insert(10))
+
+        self.assertEqual(count + 10, Entry.objects.count())
+        self.assertEqual(users + 10, User.objects.count())
+        self.assertEqual(3, len([query for query in queries
+                                 if 'blog_entry' in query['sql']]))
+        for entry in Entry.objects.all():
+            self.assertNotEmpty(entry.content)
+
+    def test_insert_force(self):
+        "Forced values are used for every row"
+
+        user = self.modelfactory[User].create()
+        self.modelfactory[Movie].insert(3, score=7)
+        self.modelfactory[Comment].insert(3, author=user, rating=None)
+
+        self.assertEqual(3, Movie.objects.filter(score=7).count())
+        self.assertEqual(3, Comment.objects.filter(
+            author=user, rating__isnull=True).count())
+
+    def test_insert_unique(self):
+        "Generated values of unique fields don't collide"
+
+        self.modelfactory.set_generator(Movie._meta.get_field('name'),
+                                        StaticGenerator("Alien"))
+        self.modelfactory[Movie].insert(5)
+
+        self.assertEqual(5, Movie.objects.values('name').distinct().count())
+
+    def test_insert_unique_together(self):
+        "Models with unique_together are filled row by row"
+
+        entry = self.modelfactory[Entry].create()
+        self.modelfactory.set_generator(SmartTag._meta.get_field('name'),
+                                        StaticGenerator("tag"))
+        self.modelfactory[SmartTag].insert(5, entry=entry)
+
+        self.assertEqual(5, entry.smart_tags.values('name').distinct().count())
+
+    def test_insert_tomany(self):
+        "To-many relationships can't be inserted"
+
+        with self.assertRaises(ValueError):
+            self.modelfactory[Entry].insert(2, comments=2)
+
+    def test_copy_data(self):
+        "Values are escaped for COPY"
+
+        data = copy_data([(1, None, True, u"a\tb\n\u00f1"),
+                          (datetime.date(2012, 1, 2), 1.5, False, "")])
+
+        self.assertEqual("1\t\\N\tt\ta\\tb\\n\xc3\xb1\n"
+                         "2012-01-02\t1.5\tf\t\n", data)
+
+
+class RelatedStrategyTests(BaseTestCase):
+
+    def setUp(self):
+        self.modelfactory = ModelFactory()
+
+    def test_pooled_related(self):
+        "Foreign keys can reuse a pool of related objects"
+
+        users = User.objects.count()
+        entries = Entry.objects.count()
+        self.modelfactory.set_related_strategy(User, PooledRelated(3))
+        self.modelfactory[Comment].create_batch(10)
+        self.modelfactory[Comment].create()
+
+        self.assertEqual(users + 3, User.objects.count())
+        self.assertEqual(entries + 11, Entry.objects.count())
+
+    def test_existing_related(self):
+        "Foreign keys can use the objects already in the database"
+
+        self.modelfactory[Entry].create_batch(2)
+        entries = list(Entry.objects.all())
+        self.modelfactory.set_related_strategy(Entry, ExistingRelated())
+        comments = self.modelfactory[Comment].create_batch(5)
+        comments.append(self.modelfactory[Comment].create())
+
+        self.assertEqual(len(entries), Entry.objects.count())
+        for comment in comments:
+            self.assertTrue(comment.post in entries)
+
+    @patch.object(CharFieldGenerator, 'get_value')
+    def test_pooled_unique_together(self, mock_my_method):
+        "unique_together is respected with pooled related objects"
+
+        mock_my_method.return_value = u'tag'
+        self.modelfactory.set_related_strategy(Entry, PooledRelated(1))
+        tags = self.modelfactory[SmartTag].create_batch(3)
+
+        self.assertEqual(3, len(set(tag.name for tag in tags)))
+
+
+class MockupBuildTests(ChocolateTestCase):
+
+    def test_build(self):
+        "Objects can be built without querying the database"
+
+        self.modelfactory[Comment].build()
+        with self.assertNumQueries(0):
+            comment = self.modelfactory[Comment].build(content="Built")
+
+        self.assertIsNone(comment.pk)
+        self.assertEqual("Built", comment.content)
+        self.assertIsNone(comment.post.pk)
+        self.assertInstanceOf(User, comment.post.author)
+
+    def test_save_graph(self):
+        "Built objects are saved along with their related objects"
+
+        comments = self.modelfactory[Comment].build_batch(3)
+        entries = Entry.objects.count()
+        self.modelfactory.save_graph(comments)
+
+        self.assertEqual(entries + 3, Entry.objects.count())
+        for comment in comments:
+            saved = Comment.objects.get(pk=comment.pk)
+            self.assertEqual(comment.post.pk, saved.post_id)
+            self.assertEqual(comment.author.pk, saved.author_id)
+
+    def test_save_graph_tomany(self):
+        "To-many relationships are created when the graph is saved"
+
+        movie = self.modelfactory[Movie].build(actors=2)
+        entry = self.modelfactory[Entry].build(comments=2)
+        self.modelfactory.save_graph([movie, entry])
+
+        self.assertEqual(2, movie.actors.count())
+        self.assertEqual(2, entry.comments.count())
+
+    def test_save_graph_unique(self):
+        "Built values taken by stored rows are replaced when saving"
+
+        Movie.objects.create(name='Alien')
+        field = Movie._meta.get_field('name')
+        self.modelfactory.set_generator(field, StaticGenerator('Alien'))
+
+        movies = self.modelfactory[Movie].build_batch(2)
+        self.modelfactory.save_graph(movies)
+
+        names = [movie.name for movie in movies]
+        self.assertEqual(2, len(set(names)))
+        self.assertTrue(all(name.startswith('Alien-') for name in names))
+        self.assertEqual(3, Movie.objects.filter(
+            name__startswith='Alien').count())
+
+    def test_save_graph_inheritance(self):
+        "Inherited models can be built and saved"
+
+        self.modelfactory.register(GutturalComment)
+        comment = self.modelfactory[GutturalComment].build()
+        self.modelfactory.save_graph([comment])
+
+        self.assertEqual(comment.translation, GutturalComment.objects.get(
+            pk=comment.pk).translation)
+
+
+class MockupPlanTests(ChocolateTestCase):
+
+    def test_plan_is_cached(self):
+        "The model introspection is compiled once per model"
+
+        mockup = self.modelfactory[Entry]
+        plan = mockup.get_plan()
+        mockup.create(comments=1)
+
+        self.assertTrue(mockup.get_plan() is plan)
+        self.assertEqual(['comments', 'smart_tags'],
+                         sorted(plan.tomany_fields))
+        self.assertEqual('post', plan.tomany['comments'].reverse_field.name)
+
+    def test_plan_without_factory(self):
+        "Data sets without a factory compile the plan of the model"
+
+        model_data = MockupData(force={'name': 'Homer'})
+        actor = model_data.build_model(Actor)
+
+        self.assertEqual('Homer', actor.name)
+        self.assertEqual(['movies'], model_data.get_fields(Actor)[0])
+
+    def test_create_without_factory(self):
+        "Data sets without a factory save objects without to-many data"
+
+        actor = MockupData(force={'name': 'Homer'}).create_model(Actor)
+        self.assertEqual('Homer', Actor.objects.get(pk=actor.pk).name)
+
+        model_data = MockupData(force={'name': 'Marge', 'movies': 2})
+        self.assertRaises(ValueError, model_data.create_model, Actor)
+        self.assertFalse(Actor.objects.filter(name='Marge').exists())
+
+    def test_plan_invalidated_on_register(self):
+        "Registering a model compiles the plans again"
+
+        mockup = self.modelfactory[Entry]
+        plan = mockup.get_plan()
+        self.modelfactory.register(ZombieEntry)
+
+        self.assertFalse(mockup.get_plan() is plan)
+
+
+class GeneratorCacheTests(ChocolateTestCase):
+
+    def test_generator_reused(self):
+        "Each field has a single generator per factory"
+
+        field = Entry._meta.get_field('content')
+        generator = self.modelfactory.get_generator(field)
+        self.modelfactory["blog.entry"].create()
+
+        self.assertTrue(self.modelfactory.get_generator(field) is generator)
+
+        self.modelfactory.reset_generators(field)
+        self.assertFalse(self.modelfactory.get_generator(field) is generator)
+
+    def test_set_generator(self):
+        "The generator of a field can be replaced"
+
+        field = Entry._meta.get_field('content')
+        self.modelfactory.set_generator(field, StaticGenerator(u'Static'))
+        try:
+            entry = self.modelfactory["blog.entry"].create()
+        finally:
+            self.modelfactory.reset_generators()
+
+        self.assertEqual(u'Static', entry.content)
+
+
+class GeneratorValuesTests(BaseTestCase):
+
+    def assertValues(self, generator, check, n=50):
+        values = generator.get_values(n)
+        self.assertEqual(n, len(values))
+        for value in values:
+            self.assertTrue(check(value), value)
+
+    def check_generators(self):
+        self.assertValues(generators.IntegerGenerator(min_value=-3,
+                                                      max_value=3),
+                          lambda v: type(v) is int and -3 <= v <= 3)
+        self.assertValues(generators.FloatGenerator(max_digits=3,
+                                                    decimal_places=1),
+                          lambda v: type(v) is float and -100 < v < 100)
+        self.assertValues(generators.DecimalGenerator(max_digits=4,
+                                                      decimal_places=2),
+                          lambda v: isinstance(v, Decimal) and abs(v) < 100)
+        self.assertValues(generators.DateGenerator(),
+                          lambda v: isinstance(v, datetime.date))
+        self.assertValues(generators.DateTimeGenerator(),
+                          lambda v: isinstance(v, datetime.datetime))
+        self.assertValues(generators.TimeGenerator(),
+                          lambda v: isinstance(v, datetime.time))
+        self.assertValues(generators.BooleanGenerator(),
+                          lambda v: v in (True, False))
+        self.assertValues(generators.IPAddressGenerator(),
+                          lambda v: len(v.split('.')) == 4)
+        self.assertValues(generators.UUIDGenerator(max_length=8),
+                          lambda v: len(v) == 8)
+
+    def test_get_values(self):
+        "Generators can produce many values at once"
+
+        self.check_generators()
+
+    def test_get_values_without_numpy(self):
+        "Many values can be generated without numpy"
+
+        with patch.object(generators, 'numpy', None):
+            self.check_generators()
+
+    def test_string_values(self):
+        "Strings keep their characters and lengths"
+
+        generator = generators.StringGenerator(chars=u'abc', min_length=2,
+                                               max_length=5)
+        check = lambda v: 2 <= len(v) <= 5 and not v.strip(u'abc')
+        self.assertTrue(check(generator.get_value()))
+        self.assertValues(generator, check, n=500)
+
+        generator = generators.StringGenerator(chars=u'\xe1\xe9', max_length=3)
+        self.assertValues(generator, lambda v: not v.strip(u'\xe1\xe9'))
+
+        self.assertValues(generators.SlugGenerator(max_length=10),
+                          lambda v: 1 <= len(v) <= 10)
+
+    def test_lorem_values(self):
+        "Lorem text is built from a pool generated once"
+
+        generator = generators.LoremGenerator()
+        value = generator.get_value()
+        self.assertTrue(value.startswith(u'Lorem ipsum dolor sit amet'))
+        self.assertEqual(3, len(value.split(u'\n\n')))
+        self.assertTrue(generators.get_lorem_pool('b', True) is
+                        generators.get_lorem_pool('b', True))
+
+        self.assertValues(generators.LoremWordGenerator(common=False),
+                          lambda v: len(v.split()) == 7)
+        self.assertValues(generators.LoremSentenceGenerator(max_length=20),
+                          lambda v: 0 < len(v) <= 20)
+
+    def test_lorem_pool_file(self):
+        "Lorem pools can be stored in a file"
+
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(CHOCOLATE_LOREM_DIR=directory):
+                with patch.object(generators, 'lorem_pools', {}):
+                    pool = generators.get_lorem_pool('s', False)
+                with patch.object(generators, 'lorem_pools', {}):
+                    loaded = generators.get_lorem_pool('s', False)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(pool.units, loaded.units)
+
+    def test_lorem_distinct_values(self):
+        "Lorem values combine units picked independently from the pool"
+
+        values = generators.LoremSentenceGenerator(common=False).get_values(
+            20000)
+        self.assertTrue(len(set(values)) > 19900, len(set(values)))
+
+    def test_pattern_values(self):
+        "Pattern generators fill placeholders from their pools"
+
+        generator = generators.PatternGenerator(
+            u'{word:1-8}@{word:1-10}.{tld}', pools={'tld': ('com', 'org')})
+        self.assertValues(generator, lambda v: re.match(
+            r'^[a-z]{1,8}@[a-z]{1,10}\.(com|org)$', v))
+
+        self.assertRaises(generators.GeneratorException,
+                          generators.PatternGenerator, u'{unknown}')
+
+    def test_email_and_url_length(self):
+        "Emails and urls respect their maximum length"
+
+        for max_length in (6, 7, 12, 30):
+            generator = generators.EmailGenerator(max_length=max_length)
+            self.assertValues(generator, lambda v: len(v) <= max_length)
+
+        generator = generators.EmailGenerator(tlds=['museum'], max_length=12)
+        self.assertValues(generator, lambda v: v.endswith('.museum') and
+                          len(v) <= 12)
+
+        for max_length in (12, 30):
+            generator = generators.URLGenerator(max_length=max_length)
+            self.assertValues(generator, lambda v: v.startswith('http://') and
+                              len(v) <= max_length)
+
+    def test_email_and_url_min_length(self):
+        "Emails and urls accept the arguments of string generators"
+
+        for min_length in (3, 10, 20, 30):
+            generator = generators.EmailGenerator(min_length=min_length,
+                                                  multiline=False)
+            self.assertValues(generator,
+                              lambda v: min_length <= len(v) <= 30)
+
+            generator = generators.URLGenerator(min_length=min_length,
+                                                multiline=False)
+            self.assertValues(generator,
+                              lambda v: min_length <= len(v) <= 30)
+
+    def test_file_path_values(self):
+        "The list of files is cached until the directory changes"
+
+        directory = tempfile.mkdtemp()
+        try:
+            open(os.path.join(directory, 'a.txt'), 'w').close()
+            generator = generators.FilePathGenerator(directory,
+                                                     match=r'\.txt$')
+            self.assertValues(generator, lambda v: v.endswith('a.txt'))
+
+            with patch.object(generator, 'scan') as scan:
+                generator.get_value()
+                self.assertFalse(scan.called)
+
+            open(os.path.join(directory, 'b.txt'), 'w').close()
+            generator.refresh()
+            self.assertEqual(2, len(generator.get_filenames()))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_get_values_empty(self):
+        "Empty values are generated with the empty_p probability"
+
+        generator = generators.IntegerGenerator(empty_p=1)
+        self.assertEqual([None] * 10, generator.get_values(10))
+
+        values = generators.NullBooleanGenerator().get_values(300)
+        self.assertTrue(None in values and True in values)
+
+
+class InstanceSelectorTests(ChocolateTestCase):
+
+    def test_select_instance(self):
+        "It selects existing instances from cached primary keys"
+
+        actors = self.modelfactory["actor"].create_batch(5)
+        selector = generators.InstanceSelector(Actor)
+
+        self.assertTrue(selector.get_value() in actors)
+        with self.assertNumQueries(1):
+            self.assertTrue(selector.get_value() in actors)
+
+    def test_select_many(self):
+        "It selects several distinct instances with one query"
+
+        self.modelfactory["actor"].create_batch(5)
+        selector = generators.InstanceSelector(Actor, min_count=3,
+                                               max_count=3)
+        selector.get_pks()
+
+        with self.assertNumQueries(1):
+            actors = selector.get_value()
+        self.assertEqual(3, len(set(actors)))
+
+    def test_select_large_batches(self):
+        "Large selections are fetched in chunks the database accepts"
+
+        self.modelfactory[Actor].insert(1200)
+        selector = generators.InstanceSelector(Actor)
+        selector.get_pks()
+
+        with self.assertNumQueries(3):
+            actors = selector.select(1200)
+        self.assertEqual(1200, len(set(actor.pk for actor in actors)))
+
+    def test_refresh_after_inserts(self):
+        "New rows are loaded after the reported inserts"
+
+        self.modelfactory["actor"].create_batch(2)
+        selector = generators.InstanceSelector(Actor, refresh_after=3)
+        self.assertEqual(2, len(selector.get_pks()))
+
+        self.modelfactory["actor"].create_batch(3)
+        selector.inserted(3)
+        self.assertEqual(5, len(selector.get_pks()))
+
+    def test_deleted_instances(self):
+        "Deleted rows are not returned"
+
+        actor = self.modelfactory["actor"].create()
+        selector = generators.InstanceSelector(Actor, fallback='none')
+        selector.get_pks()
+        actor.delete()
+
+        self.assertEqual('none', selector.get_value())
+
+
 class MockupResourceTests(ChocolateTestCase):
 
     def test_create_resource(self):
@@ -295,6 +917,474 @@ class DuplicateUniqueValuesTests(ChocolateTestCase):
         movie_2 = self.modelfactory["movie"].create()
         self.assertNotEquals(movie_1.name, movie_2.name)
 
+    @patch.object(CharFieldGenerator, 'get_value')
+    def test_derive_unique_value(self, mock_my_method):
+        """It derives a new value when the generator keeps repeating one"""
+
+        mock_my_method.return_value = u'Movie'
+
+        movie_1 = self.modelfactory["movie"].create()
+        movie_2 = self.modelfactory["movie"].create()
+        self.assertEquals(u'Movie', movie_1.name)
+        self.assertTrue(movie_2.name.startswith(u'Movie-'))
+
+    def test_derive_short_field(self):
+        """It fails when a derived value wouldn't fit in the field"""
+
+        field = models.CharField(max_length=3)
+        field.name = 'code'
+        unique = UniqueValues(Movie, [field])
+
+        values = [unique.unique_value(u'ab', lambda: u'ab', seed=False)
+                  for i in xrange(11)]
+        self.assertTrue(all(len(value) <= 3 for value in values))
+        self.assertEqual(11, len(set(values)))
+        self.assertRaises(generators.GeneratorException, unique.unique_value,
+                          u'ab', lambda: u'ab', seed=False)
+
+    def test_unique_values_in_memory(self):
+        """Unique values are only loaded once from the database"""
+
+        self.modelfactory["movie"].create()
+        with self.assertNumQueries(1):
+            self.modelfactory["movie"].create()
+
+    @patch.object(CharFieldGenerator, 'get_value')
+    def test_unique_together(self, mock_my_method):
+        """It replaces values that would break unique_together"""
+
+        mock_my_method.return_value = u'tag'
+
+        entry = self.modelfactory["entry"].create()
+        tag_1 = self.modelfactory["smarttag"].create(entry=entry)
+        tag_2 = self.modelfactory["smarttag"].create(entry=entry)
+        self.assertNotEquals(tag_1.name, tag_2.name)
+
+
+class PartitionTests(BaseTestCase):
+
+    def setUp(self):
+        self.modelfactory = ModelFactory()
+
+    def test_seed(self):
+        "Seeded generators repeat their values"
+
+        for generator in [
+                generators.StringGenerator(max_length=20),
+                generators.LoremGenerator(common=False),
+                make_generator(Movie._meta.get_field('name'))]:
+            generators.seed(7)
+            values = generator.get_values(10) + [generator.get_value()]
+            # pools built before seeding are discarded
+            generators.lorem_pools.clear()
+            generators.get_lorem_pool('s', False)
+            generators.seed(7)
+            self.assertEqual(values,
+                             generator.get_values(10) +
+                             [generator.get_value()])
+
+    @patch.object(CharFieldGenerator, 'get_value')
+    def test_partition_unique_values(self, mock_my_method):
+        "Unique values are taken only from the partition of the factory"
+
+        mock_my_method.side_effect = [str(i) for i in xrange(100)]
+        self.modelfactory.set_partition((1, 3))
+        unique = self.modelfactory.get_unique_values(Movie, ['name'])
+
+        movies = self.modelfactory[Movie].create_batch(5)
+
+        for movie in movies:
+            self.assertTrue(unique.in_partition((movie.name,)))
+        self.assertFalse(all(unique.in_partition((str(i),))
+                             for i in xrange(100)))
+
+    def test_partition_derived_values(self):
+        "Values derived in different partitions never collide"
+
+        moment = datetime.datetime(2013, 5, 1, 12, 30)
+        minute = datetime.timedelta(seconds=60)
+        # field, repeated value, range expected for the 60 values
+        cases = [
+            (models.DateTimeField(), moment, moment - minute, moment + minute),
+            (models.DecimalField(max_digits=4, decimal_places=2),
+             Decimal('99.99'), Decimal('99.30'), Decimal('99.99')),
+            (models.PositiveSmallIntegerField(), 0, 0, 65),
+        ]
+
+        for field, value, lowest, highest in cases:
+            field.name = 'value'
+            derived = []
+            for index in xrange(3):
+                unique = UniqueValues(Comment, [field], (index, 3))
+                for i in xrange(20):
+                    derived.append(unique.unique_value(
+                        value, lambda: value, seed=False))
+                    self.assertTrue(unique.in_partition((derived[-1],)))
+
+            self.assertEqual(60, len(set(derived)))
+            self.assertTrue(all(type(v) is type(value) for v in derived))
+            self.assertTrue(lowest <= min(derived), min(derived))
+            self.assertTrue(max(derived) <= highest, max(derived))
+
+    def test_partition_primary_keys(self):
+        "Primary keys are assigned from the partition of the factory"
+
+        self.modelfactory[Actor].create()
+        last = Actor.objects.order_by('-pk')[0].pk
+
+        self.modelfactory.set_partition((2, 4))
+        actors = self.modelfactory[Actor].create_batch(3)
+        actor = self.modelfactory[Actor].create()
+
+        pks = [obj.pk for obj in actors + [actor]]
+        self.assertTrue(all(pk > last and pk % 4 == 2 for pk in pks))
+        self.assertEqual(4, len(set(pks)))
+        self.assertEqual(4, Actor.objects.filter(pk__in=pks).count())
+
+    def test_populate(self):
+        "The runner creates the requested number of objects"
+
+        count = Entry.objects.count()
+
+        self.assertEqual(4, populate(self.modelfactory, Entry, 4,
+                                     processes=1, seed=1, content="Bart"))
+        self.assertEqual(count + 4, Entry.objects.count())
+        self.assertEqual(4, Entry.objects.filter(content="Bart").count())
+        self.assertIsNone(self.modelfactory.partition)
+
+
+class DatasetTests(BaseTestCase):
+
+    def test_dataset(self):
+        "It creates the objects described by a spec"
+
+        entries = Entry.objects.count()
+        users = User.objects.count()
+        spec = {
+            "models": {
+                "blog.Entry": {
+                    "count": 2,
+                    "force": {"content": "Lisa"},
+                    "tomany": {"comments": {"uniform": [3, 3]}},
+                    "related": {"auth.User": {"pool": 2}},
+                },
+            },
+        }
+
+        created = Dataset(spec, scale=2).run()
+
+        self.assertEqual({Entry: 4}, created)
+        self.assertEqual(entries + 4, Entry.objects.count())
+        self.assertEqual(users + 4, User.objects.count())
+        for entry in Entry.objects.filter(content="Lisa"):
+            self.assertEqual(3, entry.comments.count())
+
+    def test_sort_models(self):
+        "Models come after the models their foreign keys point to"
+
+        self.assertEqual([User, Entry, Comment],
+                         sort_models([Comment, Entry, User]))
+
+    def test_distributions(self):
+        "Distributions are sampled with and without numpy"
+
+        for numpy in (generators.numpy, None):
+            with patch.object(generators, 'numpy', numpy):
+                values = get_distribution({"poisson": 2}).sample(100)
+                self.assertTrue(all(value >= 0 for value in values))
+                values = get_distribution({"uniform": [0, 3]}).sample(100)
+                self.assertTrue(all(0 <= value <= 3 for value in values))
+
+        self.assertEqual([4, 4], get_distribution(4).sample(2))
+        with self.assertRaises(SpecError):
+            get_distribution({"zipf": 2})
+
+    def test_command(self):
+        "The management command runs a spec file"
+
+        actors = Actor.objects.count()
+        handle, path = tempfile.mkstemp(suffix='.json')
+        try:
+            os.write(handle, '{"seed": 3, "models": {"blog.Actor": '
+                             '{"count": 5}}}')
+            os.close(handle)
+            call_command('chocolate_populate', path, scale=2, verbosity=0)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(actors + 10, Actor.objects.count())
+
+
+class SnapshotTests(BaseTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.modelfactory = ModelFactory()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self):
+        self.modelfactory[Movie].create_batch(3, actors=2)
+
+    def get_snapshot(self, seed=1):
+        return Snapshot('movies', self.build, self.modelfactory, seed=seed,
+                        models=[Actor, Movie], directory=self.directory)
+
+    def test_restore(self):
+        "A stored snapshot replaces the rows of its tables"
+
+        self.assertFalse(self.get_snapshot().restore_or_build())
+        names = set(Movie.objects.values_list('name', flat=True))
+        actors = Actor.objects.count()
+
+        Movie.objects.all().delete()
+        self.modelfactory[Actor].create()
+
+        self.assertTrue(self.get_snapshot().restore_or_build())
+        self.assertEqual(names,
+                         set(Movie.objects.values_list('name', flat=True)))
+        self.assertEqual(actors, Actor.objects.count())
+        for movie in Movie.objects.all():
+            self.assertEqual(2, movie.actors.count())
+
+    def test_key(self):
+        "The key changes with the seed and the registered mockups"
+
+        key = self.get_snapshot().get_key()
+
+        self.assertEqual(key, self.get_snapshot().get_key())
+        self.assertNotEqual(key, self.get_snapshot(seed=2).get_key())
+        self.modelfactory.register(User, CustomMockupTestCase.UserMockup)
+        self.assertNotEqual(key, self.get_snapshot().get_key())
+
+    def test_key_mockup_bases(self):
+        "The key changes with the bases of the registered mockups"
+
+        class BaseMovieMockup(Mockup):
+            pass
+
+        class MovieMockup(BaseMovieMockup):
+            pass
+
+        self.modelfactory.register(Movie, MovieMockup)
+        sources = {}
+        with patch('chocolate.snapshots.get_source',
+                   lambda obj: sources.get(obj, repr(obj))):
+            key = self.get_snapshot().get_key()
+            sources[BaseMovieMockup] = 'class BaseMovieMockup(Mockup): x = 1'
+            self.assertNotEqual(key, self.get_snapshot().get_key())
+
+    def test_restore_content_types(self):
+        "Cached content types are discarded after restoring"
+
+        self.get_snapshot().restore_or_build()
+        ContentType.objects.get_for_model(Movie)
+
+        self.get_snapshot().restore_or_build()
+        with self.assertNumQueries(1):
+            ContentType.objects.get_for_model(Movie)
+
+    def test_no_directory(self):
+        "Without a directory the database is always built"
+
+        snapshot = Snapshot('movies', self.build, models=[Movie])
+        count = Movie.objects.count()
+
+        self.assertFalse(snapshot.restore_or_build())
+        self.assertFalse(snapshot.restore_or_build())
+        self.assertEqual(count + 6, Movie.objects.count())
+
+
+class SharedMockupsTests(MockupTestMixin, BaseTestCase):
+
+    @classmethod
+    def create_mockups(cls):
+        cls.entry = cls.modelfactory[Entry].create(content="Shared",
+                                                   comments=3)
+        cls.comments = list(cls.entry.comments.all())
+
+    def test_shared_mockups(self):
+        "Objects created once per class are available to every test"
+
+        self.assertEqual(3, self.entry.comments.count())
+        self.entry.comments.all().delete()
+
+    def test_isolated_changes(self):
+        "Changes made by a test are rolled back"
+
+        self.assertEqual(3, self.entry.comments.count())
+        self.entry.comments.all().delete()
+
+    def check_mutations(self):
+        self.assertEqual("Shared", self.entry.content)
+        self.assertEqual(3, len(self.comments))
+        self.assertTrue(all(comment.rating != -1
+                            for comment in self.comments))
+
+        self.entry.content = "Changed"
+        self.comments[0].rating = -1
+        self.comments.pop()
+
+    def test_mutated_attributes(self):
+        "Changes made to shared objects in memory don't reach other tests"
+
+        self.check_mutations()
+
+    def test_mutated_attributes_again(self):
+        "Changes made to shared objects in memory don't reach other tests"
+
+        self.check_mutations()
+
+    def test_remove_rows(self):
+        "Rows added after the marks are deleted"
+
+        marks = get_marks()
+        self.modelfactory[Movie].create(actors=2)
+        self.modelfactory.register(GutturalComment)
+        self.modelfactory[GutturalComment].create()
+
+        remove_rows(marks)
+
+        self.assertEqual(marks, get_marks())
+        self.assertTrue(Entry.objects.filter(pk=self.entry.pk).exists())
+
+
+class BenchmarkTests(BaseTestCase):
+
+    def test_percentile(self):
+        "Percentiles are taken from the sorted values"
+
+        values = range(100, 0, -1)
+        self.assertEqual(51, percentile(values, 50))
+        self.assertEqual(95, percentile(values, 95))
+
+    def test_run_benchmarks(self):
+        "Results are reported for generators, mockups and resources"
+
+        connection.use_debug_cursor = True
+        try:
+            results = run_benchmarks({
+                "repeat": 2,
+                "mockups": {"blog.Entry": {}, "blog.Movie": {"actors": 2}},
+                "api": "blog.api.api",
+                "resources": {"entry": ["get", "post"]},
+            })
+            self.assertTrue(connection.use_debug_cursor)
+        finally:
+            connection.use_debug_cursor = False
+
+        self.assertEqual(2, results['generators']['CharField']['count'])
+        self.assertEqual(2, results['mockups']['blog.Entry']['count'])
+        self.assertTrue(results['expected_queries']['blog.Movie'] > 1)
+        self.assertEqual([], check_budgets({'blog.Movie': 100}, results))
+        self.assertEqual(1, len(check_budgets({'blog.Movie': 1}, results)))
+        self.assertTrue(
+            results['mockups']['blog.Movie']['queries_per_object'] > 0)
+        for result in results['resources'].values():
+            self.assertTrue(result['p50_ms'] <= result['p95_ms'])
+            self.assertTrue(result['peak_memory_growth_kb'] >= 0)
+
+
+class InstrumentationTests(BaseTestCase):
+
+    def setUp(self):
+        self.modelfactory = ModelFactory()
+
+    def test_measure(self):
+        "Objects, queries and time are counted by model"
+
+        with self.modelfactory.measure() as counters:
+            self.modelfactory[Entry].create(comments=3)
+        stats = counters.snapshot()
+
+        entry = stats['models']['blog.Entry']
+        self.assertEqual(1, entry['objects'])
+        self.assertEqual(3, stats['models']['blog.Comment']['objects'])
+        self.assertTrue(entry['queries'] > 0)
+        self.assertEqual(set(['mockup_data', 'generate', 'save', 'tomany']),
+                         set(entry['seconds']))
+        generated = stats['generators']
+        self.assertEqual(1, generated['blog.Entry.content']['values'])
+        self.assertEqual(3, generated['blog.Comment.content']['values'])
+        self.assertEqual([], self.modelfactory.hooks)
+
+    def test_stats(self):
+        "stats returns the counters until they are disabled"
+
+        self.assertEqual({}, self.modelfactory.stats()['models'])
+
+        self.modelfactory.enable_stats()
+        self.modelfactory[Actor].create_batch(4)
+        self.assertEqual(
+            4, self.modelfactory.stats()['models']['blog.Actor']['objects'])
+
+        self.modelfactory.disable_stats()
+        self.assertEqual({}, self.modelfactory.stats()['models'])
+
+    def test_trace(self):
+        "The tree of created objects is recorded"
+
+        with self.modelfactory.trace() as trace:
+            self.modelfactory[Comment].create()
+
+        comment, save = trace.to_dict()
+        self.assertEqual(('blog.Comment', 'mockup_data', 3),
+                         (comment['model'], comment['event'], comment['rows']))
+        self.assertEqual(('blog.Comment', 'save', 1),
+                         (save['model'], save['event'], save['rows']))
+        post = [node for node in comment['children']
+                if node['name'] == 'post'][0]
+        self.assertEqual(('blog.Entry', 'related', 2),
+                         (post['model'], post['event'], post['rows']))
+
+        folded = trace.to_folded().splitlines()
+        self.assertTrue(any(
+            re.match(r'blog.Comment:mockup_data;blog.Entry:related\(post\);'
+                     r'blog.Entry:mockup_data;auth.User:related\(author\);'
+                     r'auth.User:mockup_data \d+$', line)
+            for line in folded), folded)
+        self.assertEqual([], self.modelfactory.hooks)
+
+    def test_query_budget(self):
+        "Exceeding a query budget fails with the issued queries"
+
+        self.modelfactory[User].create()
+        with self.modelfactory.query_budget(10):
+            self.modelfactory[Entry].create(comments=3)
+
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with self.modelfactory.query_budget(1):
+                self.modelfactory[Entry].create(comments=3)
+
+        message = str(context.exception)
+        self.assertTrue(message.startswith('8 queries issued'), message)
+        self.assertIn('blog.Comment 3', message)
+        self.assertIn('INSERT INTO "blog_comment"', message)
+        self.assertEqual([], self.modelfactory.hooks)
+
+    def test_hooks(self):
+        "Hooks are called around each step"
+
+        events = []
+
+        class Hook(object):
+            def start(self, span):
+                events.append(('start', span.event, span.model))
+
+            def end(self, span):
+                events.append(('end', span.event, span.model))
+
+        self.modelfactory.add_hook(Hook())
+        self.modelfactory[Actor].create()
+
+        self.assertEqual([('start', 'mockup_data', Actor),
+                          ('start', 'generate', Actor),
+                          ('end', 'generate', Actor),
+                          ('end', 'mockup_data', Actor),
+                          ('start', 'save', Actor),
+                          ('end', 'save', Actor)], events)
+
 
 class RepeatedModelNameTests(ChocolateTestCase):
     """ Tests for the case in which different apps have models with the same
@@ -325,6 +1415,26 @@ class RepeatedModelNameTests(ChocolateTestCase):
         self.modelfactory["zombie_blog.entry"].create()
 
 
+class RegistryKeyTests(BaseTestCase):
+
+    @patch.object(ContentType.objects, 'get_for_model')
+    def test_no_content_types(self, get_for_model):
+        "Models are registered and found without content types"
+
+        ContentType.objects.clear_cache()
+        modelfactory = ModelFactory()
+
+        with self.assertNumQueries(0):
+            mockup = modelfactory[Entry]
+            modelfactory.register(ZombieEntry)
+
+        self.assertIs(mockup, modelfactory["blog.entry"])
+        self.assertIs(mockup, modelfactory.models[Entry])
+        self.assertFalse(get_for_model.called)
+        with self.assertRaises(MultipleMockupsReturned):
+            modelfactory["entry"]
+
+
 class ModelInheritanceTests(ChocolateTestCase):
     """ Tests for the case in which model inheritance is applied """
 
@@ -366,3 +1476,43 @@ class ModelInheritanceTests(ChocolateTestCase):
             self.modelfactory["user"].create()
         self.modelfactory["auth.user"].create()
         self.modelfactory["zombie_blog.user"].create()
+
+
+class AtomicCreationTests(TransactionTestCase):
+    """ Tests for the creation of mockups in a single transaction """
+
+    class FailingCommentMockup(Mockup):
+
+        def mockup_data(self, data, **kwargs):
+            raise ValueError("Comments can't be created")
+
+    def setUp(self):
+        self.modelfactory = ModelFactory(use_transactions=True)
+        self.modelfactory.register(Comment, self.FailingCommentMockup)
+
+    def test_rollback_graph(self):
+        "A failure rolls back every object created by the call"
+
+        with self.assertRaises(ValueError):
+            self.modelfactory[Entry].create(comments=2)
+
+        self.assertEqual(0, Entry.objects.count())
+        self.assertEqual(0, User.objects.count())
+
+    def test_atomic_block(self):
+        "Several creations can share a transaction"
+
+        with self.assertRaises(ValueError):
+            with self.modelfactory.atomic():
+                self.modelfactory[Entry].create()
+                self.modelfactory[Comment].create()
+
+        self.assertEqual(0, Entry.objects.count())
+
+    def test_commit_graph(self):
+        "The objects are stored when the creation succeeds"
+
+        entry = self.modelfactory[Entry].create(smart_tags=2)
+
+        self.assertEqual(entry, Entry.objects.get())
+        self.assertEqual(2, SmartTag.objects.count())
@@ -117,6 +117,7 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
     'blog',
     'zombie_blog',
+    'chocolate',
 )
 
 # A sample logging configuration. The only tangible logging